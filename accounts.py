@@ -0,0 +1,118 @@
+import os
+import pickle
+import sqlite3
+from datetime import datetime
+
+class AccountUnpickler(pickle.Unpickler):
+    '''
+    Reads the accounts pickled by 401k.py and wealthfront.py: their classes were
+    recorded under __main__, so they are looked up in classes_module instead
+    '''
+    def __init__(self, file, classes_module):
+        super(AccountUnpickler, self).__init__(file)
+        self._classes_module = classes_module
+
+    def find_class(self, module, name):
+        if module == '__main__':
+            return getattr(self._classes_module, name)
+        return super(AccountUnpickler, self).find_class(module, name)
+
+def load_pickled_account(pickle_file, classes_module):
+    with open(pickle_file, 'rb') as infile:
+        return AccountUnpickler(infile, classes_module).load()
+
+def get_timestamp(value=None):
+    '''@param value: datetime, or seconds since the epoch (default: now)'''
+    if value is None:
+        value = datetime.now()
+    elif not isinstance(value, datetime):
+        value = datetime.fromtimestamp(value)
+    return value.strftime("%Y-%m-%d %H:%M:%S")
+
+def get_as_of_timestamp(as_of):
+    '''A bare date (e.g. 2017-05-01) means the end of that day'''
+    return as_of + " 23:59:59" if len(as_of) == len("YYYY-MM-DD") else as_of
+
+class AccountStore:
+    '''
+    Append-only history of accounts in SQLite.
+
+    Each commit adds one transaction row (time, target balance, note) plus one row per
+    holding it changed. Nothing is rewritten, and the state of an account at any time
+    is read with indexed lookups of the last row of each holding up to that time.
+    '''
+    def __init__(self, db_file):
+        self._connection = sqlite3.connect(db_file, timeout=30, isolation_level=None)
+        self._connection.executescript('''
+            CREATE TABLE IF NOT EXISTS transactions (id INTEGER PRIMARY KEY AUTOINCREMENT, account TEXT NOT NULL,
+                                                     committed_at TEXT NOT NULL, balance REAL NOT NULL, note TEXT);
+            CREATE INDEX IF NOT EXISTS transactions_account ON transactions (account, committed_at);
+            CREATE TABLE IF NOT EXISTS holdings (transaction_id INTEGER NOT NULL REFERENCES transactions (id),
+                                                 account TEXT NOT NULL, symbol TEXT NOT NULL,
+                                                 target_percent REAL, shares_held INTEGER);
+            CREATE INDEX IF NOT EXISTS holdings_account ON holdings (account, symbol, transaction_id);
+        ''')
+
+    def close(self):
+        self._connection.close()
+
+    def has_account(self, name):
+        return self._connection.execute("SELECT 1 FROM transactions WHERE account = ? LIMIT 1", [name]).fetchone() is not None
+
+    def _get_transaction(self, name, as_of=None):
+        if as_of:
+            return self._connection.execute("SELECT id, committed_at, balance FROM transactions WHERE account = ? AND committed_at <= ? "
+                                            "ORDER BY committed_at DESC, id DESC LIMIT 1", [name, get_as_of_timestamp(as_of)]).fetchone()
+        return self._connection.execute("SELECT id, committed_at, balance FROM transactions WHERE account = ? ORDER BY id DESC LIMIT 1",
+                                        [name]).fetchone()
+
+    def _get_holdings(self, name, transaction_id):
+        # SQLite returns the other columns of the row holding the max() of each group
+        rows = self._connection.execute("SELECT symbol, target_percent, shares_held, max(transaction_id) FROM holdings "
+                                        "WHERE account = ? AND transaction_id <= ? GROUP BY symbol", [name, transaction_id])
+        return {symbol: (target_percent, shares_held) for (symbol, target_percent, shares_held, _) in rows if target_percent is not None}
+
+    def get_account(self, name, as_of=None):
+        '''
+        @param as_of: date or time string (e.g. 2017-05-01); None means the latest commit
+        @return: (balance, dict of symbol -> (target_percent, shares_held), committed_at) or None
+        '''
+        transaction = self._get_transaction(name, as_of)
+        if not transaction:
+            return None
+        (transaction_id, committed_at, balance) = transaction
+        return (balance, self._get_holdings(name, transaction_id), committed_at)
+
+    def commit(self, name, balance, holdings, note=None, committed_at=None):
+        '''
+        Append a transaction with the holdings that differ from the last commit of name
+        @param holdings: dict of symbol -> (target_percent, shares_held)
+        @return: number of changed holdings
+        '''
+        self._connection.execute("BEGIN IMMEDIATE")
+        try:
+            last_transaction = self._get_transaction(name)
+            old_holdings = self._get_holdings(name, last_transaction[0]) if last_transaction else dict()
+            changes = [(symbol, holding[0], holding[1]) for symbol, holding in holdings.items() if old_holdings.get(symbol) != tuple(holding)]
+            # Removed holdings are recorded without a target
+            changes += [(symbol, None, None) for symbol in old_holdings if symbol not in holdings]
+            transaction_id = self._connection.execute("INSERT INTO transactions (account, committed_at, balance, note) VALUES (?, ?, ?, ?)",
+                                                      [name, get_timestamp(committed_at), balance, note]).lastrowid
+            self._connection.executemany("INSERT INTO holdings VALUES (?, ?, ?, ?, ?)",
+                                         [(transaction_id, name, symbol, target_percent, shares_held) for (symbol, target_percent, shares_held) in changes])
+            self._connection.execute("COMMIT")
+        except:
+            self._connection.execute("ROLLBACK")
+            raise
+        return len(changes)
+
+    def get_history(self, name):
+        '''@return: list of (committed_at, balance, note, number of changed holdings), oldest first'''
+        return self._connection.execute("SELECT committed_at, balance, note, (SELECT count(*) FROM holdings WHERE transaction_id = t.id) "
+                                        "FROM transactions t WHERE account = ? ORDER BY id", [name]).fetchall()
+
+def migrate_pickled_account(store, name, pickle_file, classes_module):
+    '''Record the account pickled in pickle_file as the first commit of name, dated like the file'''
+    account = load_pickled_account(pickle_file, classes_module)
+    holdings = {symbol: (holding.target_percent, holding.shares_held) for symbol, holding in account.stocks.items()}
+    store.commit(name, account.balance, holdings, "Migrated from {}".format(os.path.basename(pickle_file)), os.path.getmtime(pickle_file))
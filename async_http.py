@@ -0,0 +1,178 @@
+import asyncio
+import os
+import urllib.parse
+
+MAX_REDIRECTS = 5
+READ_CHUNK_SIZE = 64*1024
+
+class HttpError(Exception):
+    def __init__(self, url, status, reason):
+        super(HttpError, self).__init__("HTTP {} {} for {}".format(status, reason, url))
+        self.url = url
+        self.status = status
+
+class _HttpResponse:
+    def __init__(self, status, reason, headers):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+
+    def is_chunked(self):
+        return 'chunked' in self.headers.get('transfer-encoding', '').lower()
+
+    def get_content_length(self):
+        length = self.headers.get('content-length')
+        return int(length) if length is not None else None
+
+    def is_keep_alive(self):
+        return self.headers.get('connection', '').lower() != 'close' and \
+               (self.is_chunked() or self.get_content_length() is not None)
+
+class AsyncHttpPool:
+    '''
+    Minimal asyncio HTTP/1.1 client that keeps idle keep-alive connections per host
+    and streams response bodies, so many small downloads reuse a few sockets.
+    '''
+    def __init__(self, max_idle_per_host=32, timeout=60, user_agent='Mozilla/5.0'):
+        self._max_idle_per_host = max_idle_per_host
+        self._timeout = timeout
+        self._user_agent = user_agent
+        self._idle = dict()
+        self.connections_opened = 0
+        self.requests_sent = 0
+
+    async def _connect(self, key):
+        idle = self._idle.get(key)
+        while idle:
+            (reader, writer) = idle.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return (reader, writer, True)
+            writer.close()
+        (scheme, host, port) = key
+        (reader, writer) = await asyncio.open_connection(host, port, ssl=(scheme == 'https'), limit=READ_CHUNK_SIZE)
+        self.connections_opened += 1
+        return (reader, writer, False)
+
+    def _release(self, key, reader, writer):
+        idle = self._idle.setdefault(key, [])
+        if len(idle) < self._max_idle_per_host:
+            idle.append((reader, writer))
+        else:
+            writer.close()
+
+    async def _read_response_head(self, reader):
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError("Connection closed before the response")
+        parts = status_line.decode('latin-1').rstrip('\r\n').split(' ', 2)
+        status = int(parts[1])
+        reason = parts[2] if len(parts) > 2 else ''
+        headers = dict()
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            (name, _, value) = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        return _HttpResponse(status, reason, headers)
+
+    async def _read_body(self, reader, response, write):
+        if response.is_chunked():
+            while True:
+                size_line = await reader.readline()
+                size = int(size_line.split(b';', 1)[0].strip() or b'0', 16)
+                if size == 0:
+                    # Skip trailers
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    return
+                remaining = size
+                while remaining:
+                    chunk = await reader.read(min(remaining, READ_CHUNK_SIZE))
+                    if not chunk:
+                        raise asyncio.IncompleteReadError(b'', remaining)
+                    write(chunk)
+                    remaining -= len(chunk)
+                await reader.readline()
+        elif response.get_content_length() is not None:
+            remaining = response.get_content_length()
+            while remaining:
+                chunk = await reader.read(min(remaining, READ_CHUNK_SIZE))
+                if not chunk:
+                    raise asyncio.IncompleteReadError(b'', remaining)
+                write(chunk)
+                remaining -= len(chunk)
+        else:
+            while True:
+                chunk = await reader.read(READ_CHUNK_SIZE)
+                if not chunk:
+                    return
+                write(chunk)
+
+    async def _request_once(self, url, write):
+        parts = urllib.parse.urlsplit(url)
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        key = (parts.scheme, parts.hostname, port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        (reader, writer, is_reused) = await self._connect(key)
+        try:
+            request = "GET {} HTTP/1.1\r\nHost: {}\r\nUser-Agent: {}\r\nAccept-Encoding: identity\r\nConnection: keep-alive\r\n\r\n".format(
+                                                                path, parts.netloc, self._user_agent)
+            try:
+                self.requests_sent += 1
+                writer.write(request.encode('latin-1'))
+                await writer.drain()
+                response = await self._read_response_head(reader)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                if not is_reused:
+                    raise
+                # The server dropped an idle connection (seen on the write or the read): retry once on a fresh one
+                writer.close()
+                return await self._request_once(url, write)
+            is_success = response.status == 200
+            await self._read_body(reader, response, write if is_success else (lambda chunk: None))
+        except BaseException:
+            writer.close()
+            raise
+        if response.is_keep_alive():
+            self._release(key, reader, writer)
+        else:
+            writer.close()
+        return response
+
+    async def _request(self, url, write):
+        for _ in range(MAX_REDIRECTS + 1):
+            response = await asyncio.wait_for(self._request_once(url, write), self._timeout)
+            if response.status in (301, 302, 303, 307, 308) and 'location' in response.headers:
+                url = urllib.parse.urljoin(url, response.headers['location'])
+                continue
+            if response.status != 200:
+                raise HttpError(url, response.status, response.reason)
+            return
+        raise HttpError(url, response.status, "Too many redirects")
+
+    async def download(self, url, output_file):
+        '''Stream the body of url into output_file (removed again on failure)'''
+        try:
+            with open(output_file, 'wb') as outfile:
+                await self._request(url, outfile.write)
+        except BaseException:
+            try:
+                os.remove(output_file)
+            except OSError:
+                pass
+            raise
+
+    async def get(self, url):
+        '''@return: body of url as bytes'''
+        chunks = []
+        await self._request(url, chunks.append)
+        return b''.join(chunks)
+
+    async def close(self):
+        for idle in self._idle.values():
+            for (reader, writer) in idle:
+                writer.close()
+        self._idle = dict()
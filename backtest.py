@@ -0,0 +1,78 @@
+'''
+Backtest of the target_percent rebalancing of an account over its stored history.
+
+A policy checks the holdings every interval trading days and rebalances them to their
+targets when the total drift (as in the DRIFT section) exceeds its threshold. All the
+policies of a sweep are simulated together: each step over the dates updates a
+policies x holdings array, so hundreds of policies cost about as much as one.
+Shares are fractional, so the results do not depend on the account balance.
+'''
+import numpy as np
+from indicators import TRADING_DAYS_PER_YEAR
+
+DEFAULT_INTERVALS = [1, 5, 21, 63, 126, 252]
+DEFAULT_DRIFT_THRESHOLDS = [0.0, 1.0, 2.0, 5.0, 10.0]
+
+def get_policies(intervals, drift_thresholds):
+    '''@return: (intervals, drift thresholds) arrays of every combination'''
+    (interval_grid, threshold_grid) = np.meshgrid(np.asarray(intervals, dtype=np.int64), np.asarray(drift_thresholds, dtype=np.float64), indexing='ij')
+    return (interval_grid.ravel(), threshold_grid.ravel())
+
+def run_backtest(prices, target_percents, intervals, drift_thresholds, cost_rate=0.0):
+    '''
+    @param prices: holdings x dates prices, without missing values
+    @param target_percents: target percent of each holding
+    @param intervals: trading days between the rebalance checks of each policy
+    @param drift_thresholds: total drift (percent) above which each policy rebalances
+    @param cost_rate: cost of each traded dollar
+    @return: dict of name -> array with one value per policy
+    '''
+    targets = np.asarray(target_percents, dtype=np.float64)
+    targets = targets/targets.sum()
+    (policy_count, date_count) = (len(intervals), prices.shape[1])
+    shares = np.tile(targets/prices[:, 0], (policy_count, 1))
+    values = np.empty((policy_count, date_count))
+    drifts = np.empty((policy_count, date_count))
+    turnover = np.zeros(policy_count)
+    rebalance_counts = np.zeros(policy_count, dtype=np.int64)
+    for day in range(date_count):
+        holding_values = shares*prices[:, day]
+        totals = holding_values.sum(axis=1)
+        drift = 50*np.abs(holding_values/totals[:, None] - targets).sum(axis=1)
+        rebalance = (day % intervals == 0) & (drift > drift_thresholds) if day else np.zeros(policy_count, dtype=bool)
+        if rebalance.any():
+            traded = np.where(rebalance, np.abs(totals[:, None]*targets - holding_values).sum(axis=1), 0.0)
+            turnover += traded/2/totals
+            totals = totals - cost_rate*traded
+            shares = np.where(rebalance[:, None], totals[:, None]*targets/prices[:, day], shares)
+            drift = np.where(rebalance, 0.0, drift)
+            rebalance_counts += rebalance
+        values[:, day] = totals
+        drifts[:, day] = drift
+    years = max(date_count - 1, 1)/TRADING_DAYS_PER_YEAR
+    daily_returns = values[:, 1:]/values[:, :-1] - 1
+    return {'interval': np.asarray(intervals),
+            'drift_threshold': np.asarray(drift_thresholds),
+            'total_return': values[:, -1] - 1,
+            'annual_return': values[:, -1]**(1/years) - 1,
+            'volatility': daily_returns.std(axis=1)*np.sqrt(TRADING_DAYS_PER_YEAR) if date_count > 1 else np.zeros(policy_count),
+            'max_drawdown': (values/np.maximum.accumulate(values, axis=1) - 1).min(axis=1),
+            'turnover': turnover/years,
+            'mean_drift': drifts.mean(axis=1),
+            'max_drift': drifts.max(axis=1),
+            'rebalances': rebalance_counts}
+
+def print_backtest_results(results, first_date, last_date):
+    '''One line per policy, best annual return first'''
+    print ("==================== BACKTEST =========================")
+    print ("{} to {}, {} policies".format(first_date, last_date, len(results['interval'])))
+    print ("{:>8} {:>8} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9} {:>10}".format('Interval', 'Drift%', 'Return%', 'Annual%', 'Vol%',
+                                                                                  'MaxDD%', 'Turnover%', 'AvgDrift%', 'MaxDrift%', 'Rebalances'))
+    for i in np.argsort(-results['annual_return'], kind='stable'):
+        print ("{:>8} {:>8.1f} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.1f} {:>9.2f} {:>9.2f} {:>10}".format(
+                                                                results['interval'][i], results['drift_threshold'][i],
+                                                                100*results['total_return'][i], 100*results['annual_return'][i],
+                                                                100*results['volatility'][i], 100*results['max_drawdown'][i],
+                                                                100*results['turnover'][i], results['mean_drift'][i],
+                                                                results['max_drift'][i], results['rebalances'][i]))
+    print ("Turnover is the traded share of the balance per year")
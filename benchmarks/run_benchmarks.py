@@ -0,0 +1,193 @@
+'''
+Reproducible benchmarks of the loader at universe scale.
+
+Each universe is a set of synthetic tickers with 5 years of daily bars in the CSV
+layout HistoricCsvFile expects. Every stage is timed on it and the results are saved
+as JSON under benchmarks/results/, next to the results of earlier runs, so a slower
+stage shows up as a ratio against the previous run.
+
+    python benchmarks/run_benchmarks.py --sizes 10 1000 10000
+'''
+import argparse
+import contextlib
+import glob
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import stock_loader
+from stock_loader import (initialize, get_historical_data_csv_file, get_universe_store_file, download_historic_data,
+                          HistoricCsvFile, HistoricDataSetView, TickerData, get_window_stats, get_ticker_info_windows,
+                          print_ticker_info, get_ticker_indicators, StockAssistant, StockAccount, StockHolding, MAX_ALLOWED_DAYS_TO_SUBTRACT)
+from quotes import YahooQuote
+from fixture_server import FixtureServer, generate_history_csv, generate_quote
+
+DEFAULT_SIZES = [10, 1000, 10000]
+
+def get_results_folder():
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+def get_version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=os.path.dirname(get_results_folder()),
+                                       stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def get_ticker_symbols(size):
+    return ['B{:05d}'.format(i) for i in range(size)]
+
+def generate_universe(ticker_symbols):
+    start_date = datetime.today() - timedelta(days=MAX_ALLOWED_DAYS_TO_SUBTRACT)
+    for ticker_symbol in ticker_symbols:
+        with open(get_historical_data_csv_file(ticker_symbol), 'w') as outfile:
+            outfile.write(generate_history_csv(ticker_symbol, start_date, datetime.today()))
+
+def remove_caches():
+    try:
+        os.remove(get_universe_store_file())
+    except OSError:
+        pass
+    initialize()
+
+def make_account(ticker_symbols):
+    account = StockAccount()
+    account.db_name = 'benchmark'
+    account.balance = 1000.0*len(ticker_symbols)
+    account.stocks = {ticker_symbol: StockHolding(100.0/len(ticker_symbols), 1 + i % 7) for i, ticker_symbol in enumerate(ticker_symbols)}
+    return account
+
+def make_assistant(account):
+    # StockAssistant.__init__ loads the account database and downloads data; only the rebalance math is timed here
+    assistant = StockAssistant.__new__(StockAssistant)
+    assistant._default_account = account
+    assistant._account = account
+    return assistant
+
+class BenchmarkTimer:
+    def __init__(self, repeat):
+        self._repeat = repeat
+        self.results = dict()
+
+    def measure(self, name, function, setup=None):
+        '''Best of repeat runs of function(), with its output discarded'''
+        best = None
+        for _ in range(self._repeat):
+            if setup:
+                setup()
+            with contextlib.redirect_stdout(io.StringIO()):
+                start_time = time.perf_counter()
+                function()
+                elapsed = time.perf_counter() - start_time
+            best = elapsed if best is None else min(best, elapsed)
+        self.results[name] = best
+        print ("  {:<28} {:10.4f}s".format(name, best))
+        return best
+
+def run_universe(size, work_folder, repeat, concurrency, latency):
+    ticker_symbols = get_ticker_symbols(size)
+    timer = BenchmarkTimer(repeat)
+    print ("Universe of {} tickers".format(size))
+
+    # Download against a local stand-in server into an empty folder
+    download_folder = os.path.join(work_folder, 'download-{}'.format(size))
+    server = FixtureServer(latency=latency).start()
+    def reset_download_folder():
+        shutil.rmtree(download_folder, ignore_errors=True)
+        os.environ['STOCKS_DATA_FOLDER'] = download_folder
+        initialize(quote_ttl=0, backend_name='local', backend_url=server.get_url())
+    timer.measure('download', lambda: download_historic_data(ticker_symbols, lambda s: None, lambda s: None, concurrency),
+                  reset_download_folder)
+    server.shutdown()
+    shutil.rmtree(download_folder, ignore_errors=True)
+
+    data_folder = os.path.join(work_folder, 'universe-{}'.format(size))
+    os.makedirs(data_folder)
+    os.environ['STOCKS_DATA_FOLDER'] = data_folder
+    initialize()
+    timer.measure('generate', lambda: generate_universe(ticker_symbols))
+    timer.measure('parse_csv', lambda: [HistoricCsvFile(s) for s in ticker_symbols], remove_caches)
+    timer.measure('parse_cached', lambda: [HistoricCsvFile(s) for s in ticker_symbols])
+
+    tickers = [TickerData(ticker_symbol, YahooQuote(generate_quote(ticker_symbol))) for ticker_symbol in ticker_symbols]
+    for ticker in tickers:
+        ticker.get_csv_data()
+    windows = get_ticker_info_windows()
+    timer.measure('dataset_view_stats', lambda: [HistoricDataSetView(ticker, ticker.get_csv_data(), days)._get_moving_average()
+                                                 for ticker in tickers for days in windows])
+    timer.measure('window_stats', lambda: [get_window_stats(ticker.get_csv_data(), windows) for ticker in tickers])
+    timer.measure('indicators', lambda: get_ticker_indicators(tickers))
+    timer.measure('print_ticker_info', lambda: [print_ticker_info(ticker) for ticker in tickers])
+
+    account = None
+    def reset_account():
+        nonlocal account
+        account = make_account(ticker_symbols)
+    timer.measure('determine_transactions', lambda: make_assistant(account).determine_transactions(account.balance*1.1, list(tickers), False),
+                  reset_account)
+    del tickers
+    shutil.rmtree(data_folder, ignore_errors=True)
+    return timer.results
+
+def get_previous_results():
+    result_files = sorted(glob.glob(os.path.join(get_results_folder(), '*.json')))
+    if not result_files:
+        return None
+    with open(result_files[-1]) as infile:
+        return json.load(infile)
+
+def print_comparison(results, previous):
+    print ("Compared with {} ({}):".format(previous['version'], previous['timestamp']))
+    for size, stages in results['universes'].items():
+        previous_stages = previous['universes'].get(size, {})
+        for stage, seconds in stages.items():
+            if previous_stages.get(stage):
+                print ("  {:>6} {:<28} {:6.2f}x".format(size, stage, seconds/previous_stages[stage]))
+
+def process_options():
+    parser = argparse.ArgumentParser(description='Benchmark download, parse, stats and rebalance on synthetic universes.')
+    parser.add_argument('--sizes', metavar='COUNT', type=int, nargs='+', help='Universe sizes (tickers)', default=DEFAULT_SIZES)
+    parser.add_argument('--repeat', metavar='COUNT', type=int, help='Keep the best of COUNT runs per stage', default=1)
+    parser.add_argument('--downloads', metavar='COUNT', type=int, help='Maximum COUNT of concurrent downloads', default=stock_loader.DOWNLOAD_CONCURRENCY)
+    parser.add_argument('--latency', metavar='SECONDS', type=float, help='Latency of the local stand-in server', default=0.0)
+    parser.add_argument('--work_dir', metavar='FOLDER', help='Scratch FOLDER for the universes (default: a temporary folder)', default=None)
+    parser.add_argument('--no_save', action="store_true", help='Do not save the results')
+    args = parser.parse_args()
+    return args
+
+def main():
+    args = process_options()
+    work_folder = tempfile.mkdtemp(prefix='stocks-bench-', dir=args.work_dir)
+    results = {'version': get_version(),
+               'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+               'python': platform.python_version(),
+               'numpy': np.__version__,
+               'settings': {'repeat': args.repeat, 'downloads': args.downloads, 'latency': args.latency},
+               'universes': dict()}
+    try:
+        for size in args.sizes:
+            results['universes'][str(size)] = run_universe(size, work_folder, args.repeat, args.downloads, args.latency)
+    finally:
+        shutil.rmtree(work_folder, ignore_errors=True)
+    previous = get_previous_results()
+    if previous:
+        print_comparison(results, previous)
+    if not args.no_save:
+        os.makedirs(get_results_folder(), exist_ok=True)
+        output_file = os.path.join(get_results_folder(), "{}-{}.json".format(datetime.now().strftime("%Y%m%d-%H%M%S"), results['version']))
+        with open(output_file, 'w') as outfile:
+            json.dump(results, outfile, indent=2, sort_keys=True)
+        print ("Wrote: {}".format(output_file))
+
+if __name__ == '__main__':
+    main()
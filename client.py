@@ -0,0 +1,105 @@
+'''
+Thin client of daemon.py: sends one query to the running daemon and prints its answer.
+
+    python client.py ticker AAPL MSFT
+    python client.py screen --screen "pct_200 < 0 and rsi < 40" --sort=-pct_200 --top 20
+    python client.py rebalance 401k --add 500 --optimize
+    python client.py refresh
+
+It only imports the standard library, so it starts and answers in milliseconds.
+
+Every query carries the secret daemon.py keeps in the data folder, so other users and
+web pages cannot send queries to the daemon (e.g. commit trades with a rebalance).
+'''
+import argparse
+import os
+import sys
+import urllib.request, urllib.parse, urllib.error
+from data_folder import get_output_folder
+
+DEFAULT_DAEMON_PORT = 8770
+# Loading tickers the daemon does not hold yet can take a while
+CLIENT_TIMEOUT = 600
+DAEMON_TOKEN_HEADER = 'X-Stocks-Token'
+# Queries changing something, only accepted as POST
+POST_QUERIES = ['/rebalance', '/refresh']
+
+def get_daemon_url(port):
+    return "http://127.0.0.1:{}".format(port)
+
+def get_token_file():
+    return os.path.join(get_output_folder(), 'daemon.token')
+
+def read_token():
+    '''@return: secret of the daemon serving the data folder, or None before its first start'''
+    try:
+        with open(get_token_file()) as infile:
+            return infile.read().strip()
+    except OSError:
+        return None
+
+def process_options():
+    parser = argparse.ArgumentParser(description='Query a running daemon.py.')
+    parser.add_argument('--port', type=int, help='PORT of the daemon', default=DEFAULT_DAEMON_PORT)
+    subparsers = parser.add_subparsers(dest='command', metavar='COMMAND')
+    subparsers.required = True
+    subparsers.add_parser('status', help='Loaded tickers and refresh times')
+    subparsers.add_parser('refresh', help='Reload the universe now')
+    ticker_parser = subparsers.add_parser('ticker', help='Stats of tickers, like mint.py')
+    ticker_parser.add_argument('ticker_symbols', metavar='TICKER_SYMBOL', nargs='+', help='NAME of the ticker_symbol ticker symbol')
+    screen_parser = subparsers.add_parser('screen', help='Screen the universe, like mint.py --screen')
+    screen_parser.add_argument('--screen', metavar='EXPRESSION', help='Only list the tickers matching EXPRESSION', default=None)
+    screen_parser.add_argument('--sort', metavar='EXPRESSION', help='List the tickers with the largest EXPRESSION first', default=None)
+    screen_parser.add_argument('--top', metavar='COUNT', type=int, help='List COUNT tickers', default=None)
+    rebalance_parser = subparsers.add_parser('rebalance', help='Rebalance a committed account, like 401k.py')
+    rebalance_parser.add_argument('account', metavar='ACCOUNT', help='Account NAME (e.g. 401k or wealthfront)')
+    rebalance_parser.add_argument('--add', metavar='INCREMENT', help='Add INCREMENT to target BALANCE', default=None)
+    rebalance_parser.add_argument('--target_balance', metavar='BALANCE', help='Target BALANCE to keep in stocks and bonds', default=None)
+    rebalance_parser.add_argument('--commit', action="store_true", help='Commit the transactions to the account')
+    rebalance_parser.add_argument('--optimize', action="store_true", help='Pick the shares minimizing the drift within the target balance')
+    rebalance_parser.add_argument('--risk', action="store_true", help='Also report the portfolio volatility')
+    args = parser.parse_args()
+    return args
+
+def get_query(args):
+    '''@return: (path, dict of parameters) of the daemon request'''
+    if args.command == 'ticker':
+        return ('/ticker', {'symbols': ','.join(args.ticker_symbols)})
+    if args.command == 'screen':
+        return ('/screen', {'screen': args.screen, 'sort': args.sort, 'top': args.top})
+    if args.command == 'rebalance':
+        return ('/rebalance', {'account': args.account, 'add': args.add, 'target_balance': args.target_balance,
+                               'commit': args.commit, 'optimize': args.optimize, 'risk': args.risk})
+    return ('/' + args.command, {})
+
+def send_query(url, path, params, token):
+    '''@return: (HTTP status, text of the answer)'''
+    query = urllib.parse.urlencode({name: ('1' if value is True else value) for name, value in params.items()
+                                    if value is not None and value is not False})
+    request = urllib.request.Request("{}{}?{}".format(url, path, query), data=b'' if path in POST_QUERIES else None,
+                                     headers={DAEMON_TOKEN_HEADER: token})
+    try:
+        with urllib.request.urlopen(request, timeout=CLIENT_TIMEOUT) as response:
+            return (response.status, response.read().decode('utf-8'))
+    except urllib.error.HTTPError as e:
+        return (e.code, e.read().decode('utf-8'))
+
+def main():
+    args = process_options()
+    url = get_daemon_url(args.port)
+    (path, params) = get_query(args)
+    token = read_token()
+    if not token:
+        print ("ERROR: No daemon token in {}; start daemon.py first".format(get_token_file()))
+        sys.exit(1)
+    try:
+        (status, text) = send_query(url, path, params, token)
+    except urllib.error.URLError as e:
+        print ("ERROR: No daemon at {} ({}); start it with daemon.py".format(url, e.reason))
+        sys.exit(1)
+    sys.stdout.write(text)
+    if status != 200:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
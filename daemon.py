@@ -0,0 +1,354 @@
+'''
+Resident server keeping the market data of a universe loaded between queries.
+
+    python daemon.py --file symbols.txt --refresh_interval 900
+    python client.py ticker AAPL MSFT
+    python client.py screen --sort=-pct_200 --top 20
+    python client.py rebalance 401k --add 500
+
+The universe (history, live quotes, window stats and indicators) is loaded once at
+startup and again every refresh_interval seconds in a background thread. Queries read
+the last complete load, so they do not wait for the startup imports, the downloads or
+the parsing that each run of mint.py / 401k.py / wealthfront.py pays for. Tickers a
+query asks for outside the universe are loaded on first use and kept from then on.
+
+Queries are plain HTTP on localhost, answered with the text the scripts would print.
+Each one must carry the secret of the daemon.token file in the data folder (client.py
+sends it), its Host must be the local address, and the queries changing something
+are only accepted as POST, so web pages open in a browser cannot send them:
+
+    GET  /ticker?symbols=aapl,msft
+    GET  /screen?screen=...&sort=...&top=...
+    POST /rebalance?account=401k&add=...&target_balance=...&optimize=1&risk=1&commit=1
+    POST /refresh
+    GET  /status
+'''
+import argparse
+import hmac
+import io
+import os
+import re
+import secrets
+import sys
+import time
+import traceback
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread, Lock, local
+from stock_loader import (initialize, load_historic_data, get_window_stats, get_ticker_info_windows, get_ticker_indicators,
+                          print_ticker_info, StockAssistant, DOWNLOAD_CONCURRENCY, QUOTE_CACHE_TTL)
+from market_data import get_backend_names
+from timings import TIMINGS, timed
+from screener import Screener, DEFAULT_SCREEN_COUNT
+from client import DEFAULT_DAEMON_PORT, DAEMON_TOKEN_HEADER, POST_QUERIES, get_daemon_url, get_token_file, read_token
+from mint import get_symbols
+
+DEFAULT_REFRESH_INTERVAL = 900
+# Symbols name files in the data folder, so anything else (e.g. a path) is rejected
+TICKER_SYMBOL_PATTERN = re.compile(r'^[A-Za-z0-9.^=-]{1,15}$')
+
+class ThreadOutput:
+    '''
+    Replacement of sys.stdout sending what a request thread prints to its own buffer,
+    so the existing print based reports become the answers. Other threads print as usual.
+    '''
+    def __init__(self, stream):
+        self._stream = stream
+        self._local = local()
+
+    def start_capture(self):
+        self._local.buffer = io.StringIO()
+
+    def stop_capture(self):
+        '''@return: text printed since start_capture()'''
+        buffer = self._local.buffer
+        self._local.buffer = None
+        return buffer.getvalue()
+
+    def write(self, text):
+        buffer = getattr(self._local, 'buffer', None)
+        return (buffer or self._stream).write(text)
+
+    def flush(self):
+        self._stream.flush()
+
+class QueryError(Exception):
+    '''Query that cannot be answered, with the HTTP status to answer it with'''
+    def __init__(self, status, message):
+        super(QueryError, self).__init__(message)
+        self.status = status
+
+class Universe:
+    '''
+    Loaded tickers with their window stats and indicators. A Universe is not changed once
+    built: refreshes and on-demand loads build a new one, so queries can read the current
+    one without a lock.
+    '''
+    def __init__(self, tickers=None, window_stats=None, indicators=None, unknown_symbols=None):
+        self.tickers = tickers or dict()
+        self.window_stats = window_stats or dict()
+        self.indicators = indicators or dict()
+        self.unknown_symbols = unknown_symbols or set()
+        self.loaded_at = time.time()
+        self.load_seconds = 0.0
+
+    def is_known(self, ticker_symbol):
+        return ticker_symbol in self.tickers or ticker_symbol in self.unknown_symbols
+
+    def extended(self, ticker_symbols, concurrency=DOWNLOAD_CONCURRENCY):
+        '''@return: new Universe with ticker_symbols loaded too'''
+        start_time = time.time()
+        (ticker_list, unknown_list) = load_historic_data(ticker_symbols, concurrency)
+        windows = get_ticker_info_windows()
+        window_stats = dict(self.window_stats)
+        for ticker in ticker_list:
+            with timed('stats', ticker.get_name()):
+                window_stats[ticker.get_name()] = get_window_stats(ticker.get_csv_data(), windows)
+        with timed('indicators'):
+            indicators = get_ticker_indicators(ticker_list)
+        universe = Universe(dict(self.tickers, **{ticker.get_name(): ticker for ticker in ticker_list}), window_stats,
+                            dict(self.indicators, **indicators), self.unknown_symbols | set(unknown_list))
+        universe.load_seconds = time.time() - start_time
+        return universe
+
+def get_ticker_symbols(names):
+    '''
+    @return: names as ticker symbols, without duplicates. The case is kept, like the scripts
+             do: it names the CSV files, and holdings are looked up by the ticker name
+             (e.g. 'SCHB' in wealthfront, 'vbmfx' in 401k)
+    @raise ValueError: for a name that is not a ticker symbol
+    '''
+    for name in names:
+        if not TICKER_SYMBOL_PATTERN.match(name):
+            raise ValueError("Invalid ticker symbol '{}'".format(name))
+    ticker_symbols = []
+    for name in names:
+        if name not in ticker_symbols:
+            ticker_symbols.append(name)
+    return ticker_symbols
+
+def get_or_create_token():
+    '''@return: secret the queries must carry, created with the first start in the data folder'''
+    token = read_token()
+    if token:
+        return token
+    token = secrets.token_hex(16)
+    # Only readable by the user running the daemon
+    temp_file = "{}.{}.tmp".format(get_token_file(), os.getpid())
+    with os.fdopen(os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as outfile:
+        outfile.write(token)
+    os.replace(temp_file, get_token_file())
+    return token
+
+def is_set(params, name):
+    return params.get(name, '').lower() in ['1', 'true', 'yes']
+
+class StockDaemon:
+    '''
+    @param ticker_symbols: universe loaded at startup and on every refresh
+    @param refresh_interval: seconds between refreshes of the universe
+    '''
+    def __init__(self, ticker_symbols, concurrency=DOWNLOAD_CONCURRENCY, refresh_interval=DEFAULT_REFRESH_INTERVAL):
+        self._ticker_symbols = list(ticker_symbols)
+        self._concurrency = concurrency
+        self._refresh_interval = refresh_interval
+        # Loads (refreshes and tickers outside the universe) run one at a time
+        self._load_lock = Lock()
+        self._universe = Universe()
+        self._next_refresh = time.time()
+        self._queries = {'/ticker': self.query_ticker,
+                         '/screen': self.query_screen,
+                         '/rebalance': self.query_rebalance,
+                         '/refresh': self.query_refresh,
+                         '/status': self.query_status}
+
+    def refresh(self):
+        with self._load_lock:
+            TIMINGS.reset()
+            self._universe = Universe().extended(self._ticker_symbols, self._concurrency)
+            self._next_refresh = time.time() + self._refresh_interval
+        print ("Refreshed {} tickers in {:.1f} seconds".format(len(self._universe.tickers), self._universe.load_seconds))
+
+    def _run_refresh(self):
+        while True:
+            time.sleep(max(self._next_refresh - time.time(), 0))
+            # A /refresh query may have moved the next refresh meanwhile
+            if time.time() < self._next_refresh:
+                continue
+            try:
+                self.refresh()
+            except Exception:
+                traceback.print_exc()
+
+    def start(self):
+        '''Load the universe, then refresh it from a background thread'''
+        self.refresh()
+        Thread(target=self._run_refresh, daemon=True).start()
+
+    def get_tickers(self, ticker_symbols):
+        '''
+        @return: (universe, tickers of ticker_symbols), loading the ones outside the universe first
+        '''
+        universe = self._universe
+        if not all(universe.is_known(ticker_symbol) for ticker_symbol in ticker_symbols):
+            with self._load_lock:
+                universe = self._universe
+                missing_symbols = [ticker_symbol for ticker_symbol in ticker_symbols if not universe.is_known(ticker_symbol)]
+                if missing_symbols:
+                    universe = universe.extended(missing_symbols, self._concurrency)
+                    self._universe = universe
+                    self._ticker_symbols += [ticker_symbol for ticker_symbol in missing_symbols if ticker_symbol in universe.tickers]
+        return (universe, [universe.tickers[ticker_symbol] for ticker_symbol in ticker_symbols if ticker_symbol in universe.tickers])
+
+    def answer(self, path, params):
+        '''Run the query of path, printing its answer; raise QueryError when it cannot be answered'''
+        if path not in self._queries:
+            raise QueryError(404, "Unknown query {} (known: {})".format(path, ', '.join(sorted(self._queries))))
+        self._queries[path](params)
+
+    def query_ticker(self, params):
+        try:
+            ticker_symbols = get_ticker_symbols([name for name in params.get('symbols', '').split(',') if name])
+        except ValueError as e:
+            raise QueryError(400, str(e))
+        if not ticker_symbols:
+            raise QueryError(400, "No ticker symbols (symbols=A,B,...)")
+        (universe, ticker_list) = self.get_tickers(ticker_symbols)
+        for ticker in ticker_list:
+            with timed('report', ticker.get_name()):
+                print_ticker_info(ticker, universe.window_stats[ticker.get_name()], universe.indicators.get(ticker.get_name()))
+        for ticker_symbol in ticker_symbols:
+            if ticker_symbol in universe.unknown_symbols:
+                print ("ERROR: Unknown ticker symbol {}".format(ticker_symbol))
+
+    def query_screen(self, params):
+        try:
+            screener = Screener(params.get('screen'), params.get('sort'), int(params.get('top', DEFAULT_SCREEN_COUNT)))
+        except ValueError as e:
+            raise QueryError(400, str(e))
+        universe = self._universe
+        for ticker_symbol in sorted(universe.tickers):
+            with timed('screen', ticker_symbol):
+                screener.add(universe.tickers[ticker_symbol], universe.window_stats[ticker_symbol], universe.indicators.get(ticker_symbol))
+        screener.print_table()
+
+    def query_rebalance(self, params):
+        account_name = params.get('account')
+        if not account_name:
+            raise QueryError(400, "No account (account=NAME)")
+        assistant = StockAssistant.from_account_store(account_name)
+        if not assistant:
+            raise QueryError(404, "No committed account {} (run its script once first)".format(account_name))
+        try:
+            requested_target_balance = assistant.get_requested_target_balance(params.get('add'), params.get('target_balance'))
+        except ValueError as e:
+            raise QueryError(400, str(e))
+        try:
+            ticker_symbols = get_ticker_symbols(assistant.get_default_symbols())
+        except ValueError as e:
+            raise QueryError(400, "Account {}: {}".format(account_name, e))
+        (_, ticker_list) = self.get_tickers(ticker_symbols)
+        with timed('rebalance'):
+            assistant.determine_transactions(requested_target_balance, ticker_list, is_set(params, 'commit'),
+                                             is_set(params, 'optimize'), is_set(params, 'risk'))
+
+    def query_refresh(self, params):
+        self.refresh()
+
+    def query_status(self, params):
+        universe = self._universe
+        print ("Tickers: {} loaded, {} unknown".format(len(universe.tickers), len(universe.unknown_symbols)))
+        print ("Loaded: {} ({:.1f} seconds)".format(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(universe.loaded_at)), universe.load_seconds))
+        print ("Next refresh: {} (every {} seconds)".format(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self._next_refresh)),
+                                                           self._refresh_interval))
+        TIMINGS.print_summary()
+
+class DaemonRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _check_request(self, path):
+        '''Raise QueryError unless the request comes from client.py'''
+        # A page of another site resolving its own name to 127.0.0.1 still sends its name
+        if self.headers.get('Host') not in self.server.hosts:
+            raise QueryError(403, "Unexpected Host {}".format(self.headers.get('Host')))
+        token = self.headers.get(DAEMON_TOKEN_HEADER, '')
+        if not hmac.compare_digest(token.encode('utf-8'), self.server.token.encode('utf-8')):
+            raise QueryError(403, "Missing or wrong {} header (see client.py)".format(DAEMON_TOKEN_HEADER))
+        if path in POST_QUERIES and self.command != 'POST':
+            raise QueryError(405, "{} only accepts POST".format(path))
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        params = {name: values[-1] for name, values in urllib.parse.parse_qs(url.query).items()}
+        status = 200
+        sys.stdout.start_capture()
+        try:
+            self._check_request(url.path)
+            self.server.stock_daemon.answer(url.path, params)
+        except QueryError as e:
+            status = e.status
+            print ("ERROR: {}".format(e))
+        except Exception as e:
+            status = 500
+            print ("ERROR: {}".format(e))
+            traceback.print_exc()
+        finally:
+            text = sys.stdout.stop_capture()
+        self._send(status, text.encode('utf-8'))
+
+    do_POST = do_GET
+
+class DaemonServer(ThreadingHTTPServer):
+    '''
+    Answers the queries of client.py from localhost only
+    @param token: secret every query must carry in the DAEMON_TOKEN_HEADER header
+    '''
+    daemon_threads = True
+
+    def __init__(self, stock_daemon, token, port=DEFAULT_DAEMON_PORT):
+        super(DaemonServer, self).__init__(('127.0.0.1', port), DaemonRequestHandler)
+        self.stock_daemon = stock_daemon
+        self.token = token
+        self.hosts = ["{}:{}".format(host, self.server_address[1]) for host in ['127.0.0.1', 'localhost']]
+
+def process_options():
+    parser = argparse.ArgumentParser(description='Keep ticker_symbol prices loaded and answer client.py queries.')
+    parser.add_argument('ticker_symbols', metavar='TICKER_SYMBOL', nargs='*', help='NAME of the ticker_symbol ticker symbol')
+    parser.add_argument('--file', metavar='FILE_NAME', help='FILE_NAME listing ticker_symbol ticker symbols')
+    parser.add_argument('--port', type=int, help='PORT to listen on', default=DEFAULT_DAEMON_PORT)
+    parser.add_argument('--refresh_interval', metavar='SECONDS', type=int, help='Reload the universe every SECONDS', default=DEFAULT_REFRESH_INTERVAL)
+    parser.add_argument('--downloads', metavar='COUNT', type=int, help='Maximum COUNT of concurrent downloads', default=DOWNLOAD_CONCURRENCY)
+    parser.add_argument('--quote_ttl', metavar='SECONDS', type=int, help='Reuse live quotes cached less than SECONDS ago', default=QUOTE_CACHE_TTL)
+    parser.add_argument('--backend', metavar='NAME', choices=get_backend_names(), help='Market data backend NAME', default='yahoo')
+    parser.add_argument('--backend_url', metavar='URL', help='Base URL of the backend site (e.g. a local fixture_server.py)', default=None)
+    args = parser.parse_args()
+    if args.refresh_interval < 1:
+        parser.error("--refresh_interval must be at least 1 second")
+    try:
+        args.ticker_symbols = get_ticker_symbols(get_symbols(args))
+    except ValueError as e:
+        parser.error(str(e))
+    return args
+
+def main():
+    args = process_options()
+    sys.stdout = ThreadOutput(sys.stdout)
+    initialize(quote_ttl=args.quote_ttl, backend_name=args.backend, backend_url=args.backend_url)
+    stock_daemon = StockDaemon(args.ticker_symbols, args.downloads, args.refresh_interval)
+    stock_daemon.start()
+    server = DaemonServer(stock_daemon, get_or_create_token(), args.port)
+    print ("Serving queries on {} (client.py --port {})".format(get_daemon_url(args.port), args.port))
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
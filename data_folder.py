@@ -0,0 +1,5 @@
+import os
+
+def get_output_folder():
+    '''STOCKS_DATA_FOLDER overrides the default folder (e.g. for benchmarks)'''
+    return os.environ.get('STOCKS_DATA_FOLDER') or os.path.join("D:\\", 'data', 'stocks', 'db')
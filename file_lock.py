@@ -0,0 +1,36 @@
+'''
+Exclusive lock shared by processes, held on a separate lock file so the locked data
+file itself can still be replaced (e.g. by a compaction)
+'''
+import time
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+@contextmanager
+def locked_file(lock_file):
+    '''Hold an exclusive lock on lock_file (created if needed) for the with block'''
+    with open(lock_file, 'a+b') as f:
+        if fcntl:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    # LK_LOCK gives up after 10 seconds
+                    time.sleep(0.1)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
@@ -0,0 +1,186 @@
+import argparse
+import json
+import time
+import zlib
+import urllib.parse
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread, Lock
+import numpy as np
+
+# Synthetic bars start here, so a symbol has the same prices whatever range is requested
+FIXTURE_EPOCH = datetime(2000, 1, 3)
+
+def get_symbol_seed(ticker_symbol):
+    return zlib.crc32(ticker_symbol.upper().encode('utf-8'))
+
+def get_noise(seed, day_numbers, salt):
+    '''Deterministic pseudo-random values in [-0.5, 0.5) for each day number'''
+    values = (day_numbers.astype(np.uint64) * np.uint64(2654435761) + np.uint64((seed + salt*7919) % 2**32)) % np.uint64(2**32)
+    values = (values ^ (values >> np.uint64(13))) * np.uint64(1274126177) % np.uint64(2**32)
+    return values.astype(np.float64) / 2**32 - 0.5
+
+def generate_bars(ticker_symbol, start_date, end_date):
+    '''
+    Synthetic weekday bars of ticker_symbol between two datetimes
+    @return: dict of Date (datetime64[D]), Open, High, Low, Close, Adj_Close and Volume arrays, oldest first
+    '''
+    seed = get_symbol_seed(ticker_symbol)
+    first_day = max((start_date - FIXTURE_EPOCH).days, 0)
+    last_day = (end_date - FIXTURE_EPOCH).days
+    day_numbers = np.arange(first_day, last_day + 1)
+    dates = np.datetime64(FIXTURE_EPOCH.strftime("%Y-%m-%d")) + day_numbers
+    is_weekday = np.is_busday(dates)
+    (day_numbers, dates) = (day_numbers[is_weekday], dates[is_weekday])
+    base_price = 20 + seed % 300
+    trend = ((seed >> 8) % 100 - 40) / 3e5
+    close = base_price * np.exp(trend*day_numbers + 0.15*np.sin(day_numbers/(60.0 + seed % 90)) + 0.04*get_noise(seed, day_numbers, 1))
+    swing = 0.005 + 0.03*(get_noise(seed, day_numbers, 2) + 0.5)
+    open_price = close * (1 + 0.5*swing*get_noise(seed, day_numbers, 3))
+    return {'Date': dates,
+            'Open': open_price,
+            'High': np.maximum(open_price, close) * (1 + swing/2),
+            'Low': np.minimum(open_price, close) * (1 - swing/2),
+            'Close': close,
+            'Adj_Close': close * 0.98,
+            'Volume': (1e5 * (1.5 + get_noise(seed, day_numbers, 4))).astype(np.int64)}
+
+def generate_history_csv(ticker_symbol, start_date, end_date):
+    '''Synthetic bars in the Yahoo ichart CSV layout (newest first)'''
+    bars = generate_bars(ticker_symbol, start_date, end_date)
+    columns = [bars[name][::-1].tolist() for name in ['Open', 'High', 'Low', 'Close', 'Volume', 'Adj_Close']]
+    rows = zip(bars['Date'][::-1].astype(str).tolist(), *columns)
+    return "Date,Open,High,Low,Close,Volume,Adj Close\n" + ''.join(["%s,%.6f,%.6f,%.6f,%.6f,%d,%.6f\n" % row for row in rows])
+
+def generate_quote(ticker_symbol):
+    '''Synthetic quote with the YQL keys read by quotes.YahooQuote'''
+    today = datetime.today()
+    bars = generate_bars(ticker_symbol, today - timedelta(days=300), today)
+    closes = bars['Close']
+    price = closes[-1]
+    previous_close = closes[-2] if len(closes) > 1 else price
+    average_50_day = closes[-50:].mean()
+    average_200_day = closes[-200:].mean()
+    year_high = bars['High'].max()
+    year_low = bars['Low'].min()
+    return {'Symbol': ticker_symbol,
+            'Name': "{} Synthetic".format(ticker_symbol.upper()),
+            'LastTradePriceOnly': "{:.2f}".format(price),
+            'LastTradeDate': today.strftime("%m/%d/%Y").lstrip('0'),
+            'LastTradeTime': "4:00pm",
+            'Change': "{:+.2f}".format(price - previous_close),
+            'PercentChange': "{:+.2f}%".format(100*(price - previous_close)/previous_close),
+            'Open': "{:.2f}".format(bars['Open'][-1]),
+            'Volume': str(bars['Volume'][-1]),
+            'AverageDailyVolume': str(int(bars['Volume'].mean())),
+            'FiftydayMovingAverage': "{:.2f}".format(average_50_day),
+            'PercentChangeFromFiftydayMovingAverage': "{:+.2f}%".format(100*(price - average_50_day)/average_50_day),
+            'TwoHundreddayMovingAverage': "{:.2f}".format(average_200_day),
+            'PercentChangeFromTwoHundreddayMovingAverage': "{:+.2f}%".format(100*(price - average_200_day)/average_200_day),
+            'YearHigh': "{:.2f}".format(year_high),
+            'YearLow': "{:.2f}".format(year_low),
+            'PercebtChangeFromYearHigh': "{:+.2f}%".format(100*(price - year_high)/year_high),
+            'PercentChangeFromYearLow': "{:+.2f}%".format(100*(price - year_low)/year_low),
+            'ShortRatio': None}
+
+class FixtureRequestHandler(BaseHTTPRequestHandler):
+    '''
+    GET /history/<symbol>.csv?start=YYYY-MM-DD  -> Yahoo layout CSV
+    GET /quotes?symbols=A,B,C                   -> JSON list of quotes
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        self.timeout = self.server.idle_timeout
+        super(FixtureRequestHandler, self).setup()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.server.start_request()
+        try:
+            self._answer()
+        finally:
+            self.server.end_request()
+
+    def _answer(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        if url.path.startswith('/history/') and url.path.endswith('.csv'):
+            ticker_symbol = urllib.parse.unquote(url.path[len('/history/'):-len('.csv')])
+            if ticker_symbol.upper() in self.server.missing_symbols:
+                self._send(404, 'text/plain', b'Not found')
+                return
+            start_date = datetime.strptime(query['start'][0], "%Y-%m-%d") if 'start' in query else FIXTURE_EPOCH
+            body = generate_history_csv(ticker_symbol, start_date, datetime.today()).encode('ascii')
+            self._send(200, 'text/csv', body)
+        elif url.path == '/quotes':
+            ticker_symbols = [s for s in query.get('symbols', [''])[0].split(',') if s and s.upper() not in self.server.missing_symbols]
+            self._send(200, 'application/json', json.dumps([generate_quote(s) for s in ticker_symbols]).encode('utf-8'))
+        else:
+            self._send(404, 'text/plain', b'Not found')
+
+class FixtureServer(ThreadingHTTPServer):
+    '''
+    Local stand-in for the market data sites (see market_data.LocalBackend)
+    @param latency: seconds to wait before answering each request
+    @param missing_symbols: symbols answered with 404, like unknown tickers
+    @param idle_timeout: seconds before an idle keep-alive connection is closed, like sites do
+    '''
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0, missing_symbols=(), idle_timeout=None):
+        super(FixtureServer, self).__init__(('127.0.0.1', port), FixtureRequestHandler)
+        self.latency = latency
+        self.missing_symbols = set(ticker_symbol.upper() for ticker_symbol in missing_symbols)
+        self.idle_timeout = idle_timeout
+        self.request_count = 0
+        # Requests being answered, and the most at once
+        self.active_count = 0
+        self.max_active_count = 0
+        self._count_lock = Lock()
+
+    def start_request(self):
+        with self._count_lock:
+            self.request_count += 1
+            self.active_count += 1
+            self.max_active_count = max(self.max_active_count, self.active_count)
+
+    def end_request(self):
+        with self._count_lock:
+            self.active_count -= 1
+
+    def get_url(self):
+        return "http://{}:{}".format(*self.server_address)
+
+    def start(self):
+        '''Serve from a background thread'''
+        Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+def process_options():
+    parser = argparse.ArgumentParser(description='Serve synthetic market data for offline runs and benchmarks.')
+    parser.add_argument('--port', type=int, help='PORT to listen on', default=8765)
+    parser.add_argument('--latency', metavar='SECONDS', type=float, help='Delay each response by SECONDS', default=0)
+    parser.add_argument('--missing', metavar='TICKER_SYMBOL', nargs='*', help='Symbols to answer with 404', default=[])
+    args = parser.parse_args()
+    return args
+
+def main():
+    args = process_options()
+    server = FixtureServer(args.port, args.latency, args.missing)
+    print ("Serving synthetic market data on {} (--backend local --backend_url {})".format(server.get_url(), server.get_url()))
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
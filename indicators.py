@@ -0,0 +1,143 @@
+'''
+Technical indicators over a matrix of prices with one row per ticker and one column
+per date, so a whole universe is computed with array operations instead of a loop
+over tickers. Recursive indicators (EMA, RSI) step over the dates once, updating every
+ticker at a time; rolling ones use sliding windows over all rows at once.
+
+Missing bars are carried forward from the previous date; a ticker is NaN before its
+first bar.
+'''
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+TRADING_DAYS_PER_YEAR = 252
+EMA_DAYS = 20
+RSI_DAYS = 14
+VOLATILITY_DAYS = 20
+BOLLINGER_DAYS = 20
+BOLLINGER_WIDTH = 2.0
+INDICATOR_NAMES = ['ema', 'rsi', 'volatility', 'bollinger_lower', 'bollinger_upper', 'max_drawdown']
+
+def fill_forward(matrix):
+    valid = ~np.isnan(matrix)
+    index = np.where(valid, np.arange(matrix.shape[1]), 0)
+    np.maximum.accumulate(index, axis=1, out=index)
+    return matrix[np.arange(matrix.shape[0])[:, None], index]
+
+def stack_prices(columns_list, column='Adj_Close'):
+    '''
+    Align one column of several tickers on the union of their dates
+    @param columns_list: list of dict of column name -> array (e.g. HistoricCsvFile.get_columns())
+    @return: (dates, matrix of tickers x dates)
+    '''
+    if not columns_list:
+        return (np.array([], dtype='datetime64[D]'), np.empty((0, 0)))
+    dates = np.unique(np.concatenate([columns['Date'] for columns in columns_list]))
+    matrix = np.full((len(columns_list), len(dates)), np.nan)
+    for i, columns in enumerate(columns_list):
+        matrix[i, np.searchsorted(dates, columns['Date'])] = columns[column]
+    return (dates, fill_forward(matrix))
+
+def stack_latest_bars(columns_list, column='Adj_Close'):
+    '''
+    Stack one column of several tickers by bar instead of by date, with the newest bar of
+    every ticker in the last column, so the latest indicators of a ticker only see its own
+    bars (an older last bar is not carried forward over the dates of the other tickers)
+    @return: matrix of tickers x bars
+    '''
+    length = max([len(columns[column]) for columns in columns_list] + [0])
+    matrix = np.full((len(columns_list), length), np.nan)
+    for i, columns in enumerate(columns_list):
+        matrix[i, length - len(columns[column]):] = columns[column]
+    return fill_forward(matrix)
+
+def smooth(matrix, alpha):
+    '''Exponential smoothing along the dates, seeded with the first price of each ticker'''
+    result = np.empty_like(matrix)
+    previous = np.full(matrix.shape[0], np.nan)
+    for i in range(matrix.shape[1]):
+        current = matrix[:, i]
+        previous = np.where(np.isnan(previous), current, previous + alpha*(current - previous))
+        result[:, i] = previous
+    return result
+
+def smooth_latest(matrix, alpha):
+    '''Last column of smooth() as one weighted sum over the dates instead of a step per date'''
+    if not matrix.shape[1]:
+        return np.full(matrix.shape[0], np.nan)
+    decay = (1 - alpha)**np.arange(matrix.shape[1] - 1, -1, -1)
+    valid = ~np.isnan(matrix)
+    first = np.argmax(valid, axis=1)
+    values = np.nan_to_num(matrix)
+    result = values @ (alpha*decay)
+    # The first price seeds the smoothing, so it weighs (1 - alpha)^age instead of alpha*(1 - alpha)^age
+    result += values[np.arange(matrix.shape[0]), first]*(1 - alpha)*decay[first]
+    result[~valid.any(axis=1)] = np.nan
+    return result
+
+def pad_left(matrix, width):
+    '''Put the (shorter) rolling results back on the dates they end on'''
+    result = np.full((matrix.shape[0], width), np.nan)
+    if matrix.shape[1]:
+        result[:, width - matrix.shape[1]:] = matrix
+    return result
+
+def rolling_mean_std(matrix, days, ddof=0):
+    '''@return: (mean, standard deviation) of the days dates up to each date'''
+    if matrix.shape[1] < days:
+        return (np.full(matrix.shape, np.nan), np.full(matrix.shape, np.nan))
+    windows = sliding_window_view(matrix, days, axis=1)
+    return (pad_left(windows.mean(axis=2), matrix.shape[1]), pad_left(windows.std(axis=2, ddof=ddof), matrix.shape[1]))
+
+def ema(matrix, days=EMA_DAYS):
+    return smooth(matrix, 2.0/(days + 1))
+
+def get_relative_strength_index(average_gains, average_losses):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = np.where(average_losses > 0, 100 - 100/(1 + average_gains/average_losses), 100.0)
+    result[np.isnan(average_gains)] = np.nan
+    return result
+
+def rsi(matrix, days=RSI_DAYS):
+    '''Relative strength index (0-100) with Wilder's smoothing of the gains and losses'''
+    changes = np.diff(matrix, axis=1)
+    return pad_left(get_relative_strength_index(smooth(np.maximum(changes, 0), 1.0/days), smooth(np.maximum(-changes, 0), 1.0/days)),
+                    matrix.shape[1])
+
+def get_log_returns(matrix):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.diff(np.log(matrix), axis=1)
+
+def rolling_volatility(matrix, days=VOLATILITY_DAYS):
+    '''Annualized standard deviation of the daily log returns over days dates'''
+    (_, std) = rolling_mean_std(get_log_returns(matrix), days, ddof=1)
+    return pad_left(std*np.sqrt(TRADING_DAYS_PER_YEAR), matrix.shape[1])
+
+def bollinger_bands(matrix, days=BOLLINGER_DAYS, width=BOLLINGER_WIDTH):
+    '''@return: (lower, middle, upper) bands: moving average -/+ width standard deviations'''
+    (mean, std) = rolling_mean_std(matrix, days)
+    return (mean - width*std, mean, mean + width*std)
+
+def max_drawdown(matrix):
+    '''@return: largest fall from a running high of each ticker, as a (negative) fraction'''
+    running_max = np.fmax.accumulate(matrix, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.fmin.reduce(matrix/running_max - 1, axis=1)
+
+def get_latest_indicators(matrix):
+    '''
+    Indicators of every ticker on the last date, without the whole series: EMA and RSI
+    are weighted sums over the dates and rolling indicators only look at their last window
+    @return: dict of indicator name (INDICATOR_NAMES) -> array with one value per ticker
+    '''
+    if not matrix.shape[1]:
+        return {name: np.full(matrix.shape[0], np.nan) for name in INDICATOR_NAMES}
+    (lower, _, upper) = bollinger_bands(matrix[:, -BOLLINGER_DAYS:])
+    changes = np.diff(matrix, axis=1)
+    return {'ema': smooth_latest(matrix, 2.0/(EMA_DAYS + 1)),
+            'rsi': get_relative_strength_index(smooth_latest(np.maximum(changes, 0), 1.0/RSI_DAYS),
+                                               smooth_latest(np.maximum(-changes, 0), 1.0/RSI_DAYS)),
+            'volatility': rolling_volatility(matrix[:, -VOLATILITY_DAYS - 1:])[:, -1],
+            'bollinger_lower': lower[:, -1],
+            'bollinger_upper': upper[:, -1],
+            'max_drawdown': max_drawdown(matrix)}
@@ -0,0 +1,74 @@
+import json
+import os
+import zlib
+from threading import Lock
+from file_lock import locked_file
+
+MANIFEST_VERSION = 1
+
+class DataManifest:
+    '''
+    Freshness of the downloaded history of every ticker: symbol -> date of the last bar,
+    fetch time, source, row count and checksum of the CSV.
+
+    The whole manifest is read once, so deciding what to download or parse does not
+    stat one file per ticker, and copying or touching a CSV does not make it look fresh.
+    save() writes the changed entries over the ones other processes saved meanwhile,
+    through a temporary file swapped in with os.replace. The read and the swap hold the
+    lock file next to the manifest, so concurrent saves do not drop each other's entries.
+    '''
+    def __init__(self, manifest_file):
+        self._manifest_file = manifest_file
+        self._lock_file = manifest_file + '.lock'
+        self._lock = Lock()
+        self._entries = self._read()
+        self._changed = set()
+
+    def get_file(self):
+        return self._manifest_file
+
+    def _read(self):
+        try:
+            with open(self._manifest_file) as infile:
+                data = json.load(infile)
+        except (OSError, ValueError):
+            return dict()
+        if data.get('version') != MANIFEST_VERSION:
+            return dict()
+        return data.get('tickers', dict())
+
+    def get(self, ticker_symbol):
+        '''@return: dict of last_date, fetched (seconds since the epoch), source, rows and checksum, or None'''
+        with self._lock:
+            return self._entries.get(ticker_symbol)
+
+    def update(self, ticker_symbol, **fields):
+        with self._lock:
+            entry = dict(self._entries.get(ticker_symbol) or {})
+            entry.update(fields)
+            self._entries[ticker_symbol] = entry
+            self._changed.add(ticker_symbol)
+
+    def save(self):
+        with self._lock:
+            if not self._changed:
+                return
+            with locked_file(self._lock_file):
+                entries = self._read()
+                entries.update({ticker_symbol: self._entries[ticker_symbol] for ticker_symbol in self._changed})
+                temp_file = "{}.{}.tmp".format(self._manifest_file, os.getpid())
+                with open(temp_file, 'w') as outfile:
+                    json.dump({'version': MANIFEST_VERSION, 'tickers': entries}, outfile, sort_keys=True)
+                os.replace(temp_file, self._manifest_file)
+            self._entries = entries
+            self._changed = set()
+
+def get_csv_fingerprint(csv_file):
+    '''@return: dict of last_date, rows and checksum of the history in csv_file'''
+    with open(csv_file, 'rb') as infile:
+        data = infile.read()
+    # Dates are ISO formatted, so the newest one sorts last whatever the row order
+    dates = [line.split(b',', 1)[0] for line in data.splitlines()[1:] if line.strip()]
+    return {'last_date': max(dates).decode('ascii') if dates else None,
+            'rows': len(dates),
+            'checksum': "{:08x}".format(zlib.crc32(data))}
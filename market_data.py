@@ -0,0 +1,125 @@
+import asyncio
+import json
+import urllib.request, urllib.parse, urllib.error
+from datetime import datetime
+from quotes import YahooQuote, fetch_yahoo_quotes, fetch_google_quotes, fetch_cached_quotes, split_into_batches, QUOTE_BATCH_SIZE
+
+BACKENDS = dict()
+
+def register_backend(name, backend_class):
+    BACKENDS[name] = backend_class
+
+def get_backend_names():
+    return sorted(BACKENDS.keys())
+
+def get_backend(name, url=None):
+    '''@param url: base URL overriding the backend's default site (e.g. a local stand-in server)'''
+    if name not in BACKENDS:
+        raise ValueError("Unknown market data backend '{}' (known: {})".format(name, ', '.join(get_backend_names())))
+    return BACKENDS[name](url)
+
+class MarketDataBackend:
+    '''
+    Source of historic bars and live quotes.
+
+    download_history() is a coroutine so the loader can run many of them concurrently
+    over one AsyncHttpPool; get_quotes() fetches many symbols per request.
+    '''
+    name = None
+    title = None
+
+    def __init__(self, url=None):
+        self._url = url
+
+    async def download_history(self, pool, ticker_symbol, output_file, start_date):
+        '''Write the bars of ticker_symbol from start_date (a datetime) until today to output_file as CSV'''
+        raise NotImplementedError()
+
+    def get_quotes(self, ticker_symbols, cache=None):
+        '''@return: dict of ticker_symbol -> quote object for TickerData'''
+        raise NotImplementedError()
+
+    def get_quote(self, ticker_symbol):
+        return self.get_quotes([ticker_symbol]).get(ticker_symbol)
+
+class YahooBackend(MarketDataBackend):
+    name = 'yahoo'
+    title = 'Yahoo'
+
+    def make_url(self, ticker_symbol, start_date=None):
+        base_url = (self._url or "http://ichart.finance.yahoo.com") + "/table.csv?s="
+        if start_date:
+            # ichart months are zero-based
+            return base_url + ticker_symbol + "&a={}&b={}&c={}".format(start_date.month - 1, start_date.day, start_date.year)
+        return base_url + ticker_symbol
+
+    async def download_history(self, pool, ticker_symbol, output_file, start_date):
+        await pool.download(self.make_url(ticker_symbol, start_date), output_file)
+
+    def get_quotes(self, ticker_symbols, cache=None):
+        return fetch_yahoo_quotes(ticker_symbols, cache)
+
+    def get_quote(self, ticker_symbol):
+        # yahoo_finance, googlefinance and pandas_datareader are only imported when used,
+        # so starting a process (e.g. daemon.py or its clients) does not pay for them
+        from yahoo_finance import Share
+        return self.get_quotes([ticker_symbol]).get(ticker_symbol) or Share(ticker_symbol)
+
+class GoogleBackend(MarketDataBackend):
+    name = 'google'
+    title = 'Google'
+
+    def _download_history(self, ticker_symbol, output_file, start_date):
+        import pandas_datareader.data as web
+        df = web.DataReader(ticker_symbol, 'google', start_date, datetime.today())
+        df.to_csv(output_file)
+
+    async def download_history(self, pool, ticker_symbol, output_file, start_date):
+        # pandas_datareader is blocking, so keep it off the event loop
+        await asyncio.get_running_loop().run_in_executor(None, self._download_history, ticker_symbol, output_file, start_date)
+
+    def get_quotes(self, ticker_symbols, cache=None):
+        return fetch_google_quotes(ticker_symbols, cache)
+
+    def get_quote(self, ticker_symbol):
+        import googlefinance
+        return self.get_quotes([ticker_symbol]).get(ticker_symbol) or googlefinance.getQuotes(ticker_symbol)[0]
+
+class LocalBackend(MarketDataBackend):
+    '''
+    Stand-in site served by fixture_server.py: Yahoo layout CSVs and YQL style quotes
+    '''
+    name = 'local'
+    title = 'Local'
+    DEFAULT_URL = "http://127.0.0.1:8765"
+
+    def get_url(self):
+        return self._url or self.DEFAULT_URL
+
+    def make_url(self, ticker_symbol, start_date):
+        return "{}/history/{}.csv?start={}".format(self.get_url(), urllib.parse.quote(ticker_symbol), start_date.strftime("%Y-%m-%d"))
+
+    async def download_history(self, pool, ticker_symbol, output_file, start_date):
+        await pool.download(self.make_url(ticker_symbol, start_date), output_file)
+
+    def _request_quotes(self, ticker_symbols):
+        quotes = dict()
+        for batch in split_into_batches(ticker_symbols, QUOTE_BATCH_SIZE):
+            url = "{}/quotes?{}".format(self.get_url(), urllib.parse.urlencode({'symbols': ','.join(batch)}))
+            try:
+                with urllib.request.urlopen(url) as response:
+                    results = json.loads(response.read().decode('utf-8'))
+            except Exception as e:
+                print ("INFO: Local quote batch failed ({} symbols): {}".format(len(batch), e))
+                continue
+            for data in results:
+                quotes[data['Symbol']] = data
+        return quotes
+
+    def get_quotes(self, ticker_symbols, cache=None):
+        quotes = fetch_cached_quotes(self.name, ticker_symbols, self._request_quotes, cache)
+        return {ticker_symbol: YahooQuote(data) for ticker_symbol, data in quotes.items()}
+
+register_backend(YahooBackend.name, YahooBackend)
+register_backend(GoogleBackend.name, GoogleBackend)
+register_backend(LocalBackend.name, LocalBackend)
@@ -0,0 +1,203 @@
+import json
+import sqlite3
+import time
+import urllib.request, urllib.parse, urllib.error
+from datetime import datetime
+from threading import Lock
+
+QUOTE_BATCH_SIZE = 100
+QUOTE_CACHE_TTL = 15*60
+QUOTE_CACHE_MAX_ENTRIES = 20000
+YQL_URL = "https://query.yahooapis.com/v1/public/yql"
+YQL_ENV = "store://datatables.org/alltableswithkeys"
+
+def split_into_batches(seq, batch_size):
+    return [seq[i:i + batch_size] for i in range(0, len(seq), batch_size)]
+
+class YahooQuote:
+    '''
+    Yahoo Finance quote fetched in a batch, with the getters of yahoo_finance.Share
+    '''
+    def __init__(self, data):
+        self.data_set = data
+
+    def _get(self, key):
+        return self.data_set.get(key)
+
+    def get_name(self):
+        return self._get('Name')
+
+    def get_price(self):
+        return self._get('LastTradePriceOnly')
+
+    def get_trade_datetime(self):
+        if not self._get('LastTradeDate') or not self._get('LastTradeTime'):
+            return None
+        try:
+            trade_time = datetime.strptime("{} {}".format(self._get('LastTradeDate'), self._get('LastTradeTime')), "%m/%d/%Y %I:%M%p")
+        except ValueError:
+            return "{} {}".format(self._get('LastTradeDate'), self._get('LastTradeTime'))
+        return trade_time.strftime("%Y-%m-%d %H:%M:%S")
+
+    def get_change(self):
+        return self._get('Change')
+
+    def get_open(self):
+        return self._get('Open')
+
+    def get_percent_change(self):
+        return self._get('PercentChange')
+
+    def get_volume(self):
+        return self._get('Volume')
+
+    def get_avg_daily_volume(self):
+        return self._get('AverageDailyVolume')
+
+    def get_50day_moving_avg(self):
+        return self._get('FiftydayMovingAverage')
+
+    def get_percent_change_from_50_day_moving_average(self):
+        return self._get('PercentChangeFromFiftydayMovingAverage')
+
+    def get_200day_moving_avg(self):
+        return self._get('TwoHundreddayMovingAverage')
+
+    def get_percent_change_from_200_day_moving_average(self):
+        return self._get('PercentChangeFromTwoHundreddayMovingAverage')
+
+    def get_year_high(self):
+        return self._get('YearHigh')
+
+    def get_year_low(self):
+        return self._get('YearLow')
+
+    def get_percent_change_from_year_high(self):
+        # Yahoo's own spelling
+        return self._get('PercebtChangeFromYearHigh')
+
+    def get_percent_change_from_year_low(self):
+        return self._get('PercentChangeFromYearLow')
+
+    def get_short_ratio(self):
+        return self._get('ShortRatio')
+
+    def get_price_earnings_ratio(self):
+        return self._get('PERatio')
+
+    def get_price_earnings_growth_ratio(self):
+        return self._get('PEGRatio')
+
+    def get_earnings_share(self):
+        return self._get('EarningsShare')
+
+class QuoteCache:
+    '''
+    Disk-backed quote cache keyed by (source, symbol), shared by every process that
+    opens the same file. Entries older than ttl seconds are misses, and the least
+    recently used entries are evicted above max_entries.
+    '''
+    def __init__(self, db_file, ttl=QUOTE_CACHE_TTL, max_entries=QUOTE_CACHE_MAX_ENTRIES):
+        self._ttl = ttl
+        self._max_entries = max_entries
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self._connection = sqlite3.connect(db_file, timeout=30, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS quotes (source TEXT, symbol TEXT, data TEXT, "
+                                 "fetched_at REAL, accessed_at REAL, PRIMARY KEY (source, symbol))")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS quotes_accessed_at ON quotes (accessed_at)")
+
+    def get_many(self, source, ticker_symbols):
+        '''@return: dict of ticker_symbol -> quote data for the fresh entries'''
+        found = dict()
+        now = time.time()
+        with self._lock:
+            for batch in split_into_batches(ticker_symbols, 500):
+                rows = self._connection.execute("SELECT symbol, data FROM quotes WHERE source = ? AND fetched_at >= ? AND symbol IN ({})".format(
+                                                        ','.join('?' * len(batch))), [source, now - self._ttl] + batch).fetchall()
+                for (ticker_symbol, data) in rows:
+                    found[ticker_symbol] = json.loads(data)
+                self._connection.executemany("UPDATE quotes SET accessed_at = ? WHERE source = ? AND symbol = ?",
+                                             [(now, source, ticker_symbol) for ticker_symbol, _ in rows])
+            self.hits += len(found)
+            self.misses += len(ticker_symbols) - len(found)
+        return found
+
+    def put_many(self, source, quotes):
+        now = time.time()
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                self._connection.executemany("INSERT OR REPLACE INTO quotes VALUES (?, ?, ?, ?, ?)",
+                                             [(source, ticker_symbol, json.dumps(data), now, now) for ticker_symbol, data in quotes.items()])
+                self._connection.execute("DELETE FROM quotes WHERE rowid IN (SELECT rowid FROM quotes ORDER BY accessed_at "
+                                         "LIMIT max(0, (SELECT count(*) FROM quotes) - ?))", [self._max_entries])
+                self._connection.execute("COMMIT")
+            except:
+                self._connection.execute("ROLLBACK")
+                raise
+
+    def get_summary(self):
+        return "Quote cache: {} hits, {} misses".format(self.hits, self.misses)
+
+def fetch_cached_quotes(source, ticker_symbols, fetch, cache):
+    '''Look ticker_symbols up in cache first and fetch only the misses'''
+    if not cache:
+        return fetch(ticker_symbols)
+    quotes = cache.get_many(source, ticker_symbols)
+    fetched = fetch([ticker_symbol for ticker_symbol in ticker_symbols if ticker_symbol not in quotes])
+    if fetched:
+        cache.put_many(source, fetched)
+    quotes.update(fetched)
+    return quotes
+
+def make_yql_url(ticker_symbols):
+    query = 'select * from yahoo.finance.quotes where symbol in ({})'.format(
+                                            ','.join('"{}"'.format(ticker_symbol) for ticker_symbol in ticker_symbols))
+    return YQL_URL + '?' + urllib.parse.urlencode({'q': query, 'format': 'json', 'env': YQL_ENV})
+
+def fetch_yahoo_quotes(ticker_symbols, cache=None):
+    '''@return: dict of ticker_symbol -> YahooQuote, one request per QUOTE_BATCH_SIZE uncached symbols'''
+    quotes = fetch_cached_quotes('yahoo', ticker_symbols, request_yahoo_quotes, cache)
+    return {ticker_symbol: YahooQuote(data) for ticker_symbol, data in quotes.items()}
+
+def request_yahoo_quotes(ticker_symbols):
+    quotes = dict()
+    for batch in split_into_batches(ticker_symbols, QUOTE_BATCH_SIZE):
+        try:
+            with urllib.request.urlopen(make_yql_url(batch)) as response:
+                results = json.loads(response.read().decode('utf-8'))['query']['results']['quote']
+        except Exception as e:
+            print ("INFO: Yahoo quote batch failed ({} symbols): {}".format(len(batch), e))
+            continue
+        if isinstance(results, dict):
+            results = [results]
+        symbols_by_upper = {ticker_symbol.upper(): ticker_symbol for ticker_symbol in batch}
+        for data in results:
+            ticker_symbol = symbols_by_upper.get((data.get('Symbol') or data.get('symbol') or '').upper())
+            if ticker_symbol and data.get('LastTradePriceOnly') is not None:
+                quotes[ticker_symbol] = data
+    return quotes
+
+def fetch_google_quotes(ticker_symbols, cache=None):
+    '''@return: dict of ticker_symbol -> googlefinance quote dict, one request per QUOTE_BATCH_SIZE uncached symbols'''
+    return fetch_cached_quotes('google', ticker_symbols, request_google_quotes, cache)
+
+def request_google_quotes(ticker_symbols):
+    # Imported on first use only, like the other site libraries in market_data.py
+    import googlefinance
+    quotes = dict()
+    for batch in split_into_batches(ticker_symbols, QUOTE_BATCH_SIZE):
+        try:
+            results = googlefinance.getQuotes(batch)
+        except Exception as e:
+            print ("INFO: Google quote batch failed ({} symbols): {}".format(len(batch), e))
+            continue
+        symbols_by_upper = {ticker_symbol.upper(): ticker_symbol for ticker_symbol in batch}
+        for data in results:
+            ticker_symbol = symbols_by_upper.get(data.get('StockSymbol', '').upper())
+            if ticker_symbol:
+                quotes[ticker_symbol] = data
+    return quotes
@@ -0,0 +1,151 @@
+'''
+Covariance and correlation of the daily returns of many tickers.
+
+Covariances come from pair sums over the dates where both tickers have a return (sum of
+products, sum of each side and count), so tickers with a shorter history are compared
+over the dates they share. The sums are computed in blocks of tickers, and only the
+blocks on and above the diagonal since the matrices are symmetric.
+
+CovarianceCache saves the sums of a universe under the data folder. When new bars arrive,
+the sums of the new dates are added and the ones of the dates that left the window are
+subtracted, instead of going over the whole window again. A hash of the returns they
+were computed from is saved with them, so restated or downloaded again bars with the
+same dates are not mistaken for the cached ones.
+'''
+import hashlib
+import json
+import os
+import numpy as np
+from indicators import TRADING_DAYS_PER_YEAR
+
+# Returns of the most recent RISK_DAYS dates
+RISK_DAYS = 252
+RISK_BLOCK_SIZE = 512
+# Sums are computed again from scratch after this many incremental updates, before rounding errors add up
+RISK_MAX_UPDATES = 20
+
+def get_returns(matrix):
+    '''Daily returns of a tickers x dates price matrix; NaN before the first bar of a ticker'''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return matrix[:, 1:]/matrix[:, :-1] - 1
+
+def get_returns_hash(returns):
+    return hashlib.sha1(np.ascontiguousarray(returns).tobytes()).hexdigest()
+
+def get_pair_sums(returns, block_size=RISK_BLOCK_SIZE):
+    '''
+    @return: (products, sums, counts) where over the dates both tickers i and j have a return,
+             products[i, j] is the sum of x_i*x_j, sums[i, j] the sum of x_i and counts[i, j] their number
+    '''
+    valid = ~np.isnan(returns)
+    values = np.where(valid, returns, 0.0)
+    weights = valid.astype(np.float64)
+    count = returns.shape[0]
+    (products, sums, counts) = (np.empty((count, count)), np.empty((count, count)), np.empty((count, count)))
+    for start in range(0, count, block_size):
+        rows = slice(start, start + block_size)
+        for other_start in range(start, count, block_size):
+            columns = slice(other_start, other_start + block_size)
+            products[rows, columns] = values[rows] @ values[columns].T
+            sums[rows, columns] = values[rows] @ weights[columns].T
+            sums[columns, rows] = values[columns] @ weights[rows].T
+            counts[rows, columns] = weights[rows] @ weights[columns].T
+            if other_start != start:
+                products[columns, rows] = products[rows, columns].T
+                counts[columns, rows] = counts[rows, columns].T
+    return (products, sums, counts)
+
+def get_covariance_from_sums(products, sums, counts):
+    '''Sample covariance of each pair of tickers; NaN with less than 2 shared returns'''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        covariance = (products - sums*sums.T/counts)/(counts - 1)
+    covariance[counts < 2] = np.nan
+    return covariance
+
+def get_covariance(returns):
+    return get_covariance_from_sums(*get_pair_sums(returns))
+
+def get_correlation(covariance):
+    deviations = np.sqrt(np.diag(covariance))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return covariance/np.outer(deviations, deviations)
+
+def get_portfolio_volatility(weights, covariance):
+    '''Annualized volatility of a portfolio with weights (fractions of its balance); unknown covariances count as 0'''
+    weights = np.asarray(weights, dtype=np.float64)
+    variance = float(weights @ np.nan_to_num(covariance) @ weights)
+    return np.sqrt(max(variance, 0.0)*TRADING_DAYS_PER_YEAR)
+
+class CovarianceCache:
+    '''
+    Pair sums of the returns of a universe over its last RISK_DAYS dates, saved per universe
+    (the list of ticker symbols) with the dates of the window
+    '''
+    def __init__(self, cache_folder):
+        self._cache_folder = cache_folder
+
+    def get_file(self, ticker_symbols):
+        key = hashlib.sha1('\n'.join(ticker_symbols).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self._cache_folder, "covariance-{}.npz".format(key))
+
+    def _load(self, cache_file, ticker_symbols):
+        try:
+            with np.load(cache_file) as data:
+                info = json.loads(str(data['info']))
+                if info['symbols'] != ticker_symbols:
+                    return None
+                return (info, data['products'], data['sums'], data['counts'])
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _save(self, cache_file, info, products, sums, counts):
+        os.makedirs(self._cache_folder, exist_ok=True)
+        temp_file = "{}.{}.tmp.npz".format(cache_file[:-len('.npz')], os.getpid())
+        np.savez(temp_file, info=json.dumps(info), products=products, sums=sums, counts=counts)
+        os.replace(temp_file, cache_file)
+
+    def _update(self, cached, dates, returns, first_index):
+        '''
+        Move the cached window to end on the last date, or None if it does not line up
+        with dates (e.g. the bars were downloaded again)
+        '''
+        (info, products, sums, counts) = cached
+        (old_first, old_last) = np.searchsorted(dates, np.array([info['first_date'], info['last_date']], dtype='datetime64[D]'))
+        if (info['updates'] >= RISK_MAX_UPDATES or old_last >= len(dates) or str(dates[old_first]) != info['first_date'] or
+                str(dates[old_last]) != info['last_date'] or old_last - old_first + 1 != info['size'] or old_first > first_index or
+                get_returns_hash(returns[:, old_first:old_last + 1]) != info.get('returns_hash')):
+            return None
+        for (columns, sign) in [(slice(old_last + 1, len(dates)), 1), (slice(old_first, first_index), -1)]:
+            if columns.stop > columns.start:
+                (new_products, new_sums, new_counts) = get_pair_sums(returns[:, columns])
+                products += sign*new_products
+                sums += sign*new_sums
+                counts += sign*new_counts
+        info['updates'] += 1
+        return (info, products, sums, counts)
+
+    def get_covariance(self, ticker_symbols, dates, returns):
+        '''
+        @param dates: date of each column of returns, oldest first
+        @param returns: tickers x dates daily returns, in the order of ticker_symbols
+        @return: covariance matrix of the daily returns over the last RISK_DAYS dates
+        '''
+        ticker_symbols = list(ticker_symbols)
+        first_index = max(len(dates) - RISK_DAYS, 0)
+        if not len(dates):
+            return np.full((len(ticker_symbols), len(ticker_symbols)), np.nan)
+        window = {'first_date': str(dates[first_index]), 'last_date': str(dates[-1]), 'size': len(dates) - first_index,
+                  'returns_hash': get_returns_hash(returns[:, first_index:])}
+        cache_file = self.get_file(ticker_symbols)
+        cached = self._load(cache_file, ticker_symbols)
+        if cached and all(cached[0].get(key) == value for key, value in window.items()):
+            return get_covariance_from_sums(*cached[1:])
+        cached = self._update(cached, dates, returns, first_index) if cached else None
+        if cached:
+            (info, products, sums, counts) = cached
+        else:
+            info = {'symbols': ticker_symbols, 'updates': 0}
+            (products, sums, counts) = get_pair_sums(returns[:, first_index:])
+        info.update(window)
+        self._save(cache_file, info, products, sums, counts)
+        return get_covariance_from_sums(products, sums, counts)
@@ -0,0 +1,170 @@
+'''
+Cross-sectional screener over the stats mint.py computes for every ticker.
+
+A filter and a sort key are small expressions over per-ticker values, e.g.
+
+    mint.py --file symbols.txt --screen "pct_200 < 0 and rsi < 40" --sort=-pct_200 --top 50
+
+lists the 50 tickers furthest below their 200 day average among those with an RSI under
+40. Tickers are screened one at a time as the pipeline produces them and only the best
+--top rows are kept (in a bounded heap), so memory does not grow with the universe.
+'''
+import ast
+import heapq
+import itertools
+import math
+
+# Suffixes of the windows of get_ticker_info_windows(), in order
+SCREEN_WINDOW_NAMES = ['50', '200', '1y', 'max']
+SCREEN_WINDOW_VALUES = ['ma', 'pct', 'change', 'swing_min', 'swing_max', 'swing_avg']
+SCREEN_INDICATOR_VALUES = ['ema', 'rsi', 'volatility', 'bollinger_lower', 'bollinger_upper', 'max_drawdown']
+SCREEN_VALUE_NAMES = (['price'] + ["{}_{}".format(value, window) for window in SCREEN_WINDOW_NAMES for value in SCREEN_WINDOW_VALUES] +
+                      SCREEN_INDICATOR_VALUES)
+SCREEN_FUNCTIONS = {'abs': abs, 'min': min, 'max': max}
+SCREEN_NODES = (ast.Expression, ast.BoolOp, ast.And, ast.Or, ast.BinOp, ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Mod,
+                ast.UnaryOp, ast.UAdd, ast.USub, ast.Not, ast.Compare, ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.Eq, ast.NotEq,
+                ast.Name, ast.Load, ast.Constant, ast.Call)
+DEFAULT_SCREEN_COUNT = 50
+
+def get_percent(now, base):
+    return 100.0*(now - base)/base if base else float('nan')
+
+class ScreenValues:
+    '''
+    Values of one ticker for the expressions, computed on first use: the indicators
+    are only computed when an expression refers to them
+    '''
+    def __init__(self, ticker, window_stats, indicators=None):
+        self._ticker = ticker
+        self._window_stats = window_stats
+        self._indicators = indicators
+        self._values = None
+
+    def _get_price(self):
+        try:
+            return float(self._ticker.get_last_price())
+        except (TypeError, ValueError, KeyError):
+            return float('nan')
+
+    def _get_window_values(self):
+        values = {'price': self._get_price()}
+        for name, stats in zip(SCREEN_WINDOW_NAMES, self._window_stats):
+            if not stats.size:
+                values.update({"{}_{}".format(value, name): float('nan') for value in SCREEN_WINDOW_VALUES})
+                continue
+            values["ma_" + name] = stats.moving_average
+            values["pct_" + name] = get_percent(values['price'], stats.moving_average)
+            values["change_" + name] = get_percent(values['price'], stats.first_closing_price)
+            values["swing_min_" + name] = 100*stats.swing_min
+            values["swing_max_" + name] = 100*stats.swing_max
+            values["swing_avg_" + name] = 100*stats.swing_avg
+        return values
+
+    def __getitem__(self, name):
+        if self._values is None:
+            self._values = self._get_window_values()
+        if name not in self._values and name in SCREEN_INDICATOR_VALUES:
+            indicators = self._indicators or self._ticker.get_csv_data().get_indicators()
+            self._values.update({value: indicators[value] for value in SCREEN_INDICATOR_VALUES})
+            for value in ['volatility', 'max_drawdown']:
+                self._values[value] *= 100
+        return self._values[name]
+
+class ScreenExpression:
+    '''
+    Arithmetic, comparisons and and/or/not over SCREEN_VALUE_NAMES, numbers and abs/min/max.
+    Anything else (attributes, subscripts, other calls, strings, ...) is rejected before
+    the expression is compiled, so it cannot reach anything but the values of a ticker.
+    '''
+    def __init__(self, text):
+        try:
+            tree = ast.parse(text.strip(), mode='eval')
+        except SyntaxError as e:
+            raise ValueError("Invalid expression '{}': {}".format(text, e.msg))
+        self.names = []
+        for node in ast.walk(tree):
+            if not isinstance(node, SCREEN_NODES):
+                raise ValueError("'{}' is not allowed in '{}'".format(type(node).__name__, text))
+            if isinstance(node, ast.Call):
+                if not isinstance(node.func, ast.Name) or node.func.id not in SCREEN_FUNCTIONS or node.keywords:
+                    raise ValueError("Only {} can be called in '{}'".format('/'.join(SCREEN_FUNCTIONS), text))
+            elif isinstance(node, ast.Constant):
+                if not isinstance(node.value, (int, float)):
+                    raise ValueError("Only numbers are allowed in '{}'".format(text))
+            elif isinstance(node, ast.Name) and node.id not in SCREEN_FUNCTIONS:
+                if node.id not in SCREEN_VALUE_NAMES:
+                    raise ValueError("Unknown value '{}' in '{}' (known: {})".format(node.id, text, ', '.join(SCREEN_VALUE_NAMES)))
+                if node.id not in self.names:
+                    self.names.append(node.id)
+        self._text = text
+        self._code = compile(tree, '<screen>', 'eval')
+
+    def get_text(self):
+        return self._text
+
+    def evaluate(self, values):
+        '''@return: value of the expression, NaN when it does not have one (e.g. a division by zero)'''
+        try:
+            return eval(self._code, {'__builtins__': {}, **SCREEN_FUNCTIONS}, values)
+        except ArithmeticError:
+            return float('nan')
+
+class TopRows:
+    '''The count rows with the largest keys so far; ties keep the earlier row'''
+    def __init__(self, count):
+        self._count = count
+        self._heap = []
+        self._order = itertools.count()
+
+    def add(self, key, row):
+        item = (key, -next(self._order), row)
+        if len(self._heap) < self._count:
+            heapq.heappush(self._heap, item)
+        elif item > self._heap[0]:
+            heapq.heapreplace(self._heap, item)
+
+    def get_rows(self):
+        '''@return: list of (key, row), largest key first'''
+        return [(key, row) for key, _, row in sorted(self._heap, reverse=True)]
+
+class Screener:
+    '''
+    Keep the count tickers passing the filter with the largest sort key (the first count
+    without a sort key). add() is called from a single thread (mint.py's reporter stage).
+    '''
+    def __init__(self, filter_text=None, sort_text=None, count=DEFAULT_SCREEN_COUNT):
+        self._filter = ScreenExpression(filter_text) if filter_text else None
+        self._sort = ScreenExpression(sort_text) if sort_text else None
+        self._top_rows = TopRows(count)
+        self._columns = ['price']
+        for expression in [self._sort, self._filter]:
+            if expression:
+                self._columns += [name for name in expression.names if name not in self._columns]
+        self._screened_count = 0
+        self._matched_count = 0
+
+    def add(self, ticker, window_stats, indicators=None):
+        '''@param indicators: precomputed indicators of ticker, if any'''
+        self._screened_count += 1
+        values = ScreenValues(ticker, window_stats, indicators)
+        if self._filter:
+            matched = self._filter.evaluate(values)
+            if not matched or (isinstance(matched, float) and math.isnan(matched)):
+                return
+        key = float(self._sort.evaluate(values)) if self._sort else 0.0
+        if math.isnan(key):
+            return
+        self._matched_count += 1
+        self._top_rows.add(key, [ticker.get_name().upper()] + [values[name] for name in self._columns])
+
+    def print_table(self):
+        rows = self._top_rows.get_rows()
+        print ("==================== SCREEN ============================")
+        if self._filter:
+            print ("Filter: {}".format(self._filter.get_text()))
+        if self._sort:
+            print ("Sort:   {} (largest first)".format(self._sort.get_text()))
+        print ("{:>4} {:<8}".format('#', 'Ticker') + ''.join(" {:>12}".format(name) for name in (['sort'] if self._sort else []) + self._columns))
+        for rank, (key, row) in enumerate(rows, 1):
+            print ("{:>4} {:<8}".format(rank, row[0]) + ''.join(" {:>12.2f}".format(value) for value in ([key] if self._sort else []) + row[1:]))
+        print ("{} of {} matching tickers ({} screened)".format(len(rows), self._matched_count, self._screened_count))
@@ -1,4 +1,6 @@
+import asyncio
 import json
+import math
 import re
 from queue import Queue
 from threading import Thread, Lock
@@ -7,23 +9,52 @@ import sys
 import urllib.request, urllib.parse, urllib.error
 import time
 import argparse
-from yahoo_finance import Share
-from rtstock.stock import Stock
 from pprint import pprint
 from datetime import datetime, timedelta
 from functools import reduce
+from itertools import zip_longest
 import csv
 from multiprocessing import Pool
-import googlefinance 
-import pandas_datareader.data as web
 import pickle
+import shutil
+import heapq
+import numpy as np
+from async_http import AsyncHttpPool, HttpError
+from data_folder import get_output_folder
+from quotes import QuoteCache, QUOTE_BATCH_SIZE, QUOTE_CACHE_TTL
+from market_data import get_backend, get_backend_names
+from timings import TIMINGS, timed, run_profiled
+from accounts import AccountStore, migrate_pickled_account, get_as_of_timestamp
+from universe_store import UniverseStore, COMPACT_STALE_RATIO
+from manifest import DataManifest, get_csv_fingerprint
+from indicators import stack_prices, stack_latest_bars, get_latest_indicators, INDICATOR_NAMES, EMA_DAYS, RSI_DAYS, VOLATILITY_DAYS, BOLLINGER_DAYS
+from risk import CovarianceCache, get_returns, get_portfolio_volatility, RISK_DAYS, TRADING_DAYS_PER_YEAR
+from backtest import get_policies, run_backtest, print_backtest_results, DEFAULT_INTERVALS, DEFAULT_DRIFT_THRESHOLDS
 
 # TODOs:
 #   Get new share distribution and deviation percentage
-#   Store an array of accounts (to show history of balances)
 
 MAX_ALLOWED_DAYS_TO_SUBTRACT = 5*365
+HISTORIC_PRICE_COLUMNS = ['Open', 'High', 'Low', 'Close', 'Adj_Close']
+HISTORIC_COLUMN_TYPES = [('Date', '<M8[D]')] + [(name, '<f8') for name in HISTORIC_PRICE_COLUMNS] + [('Volume', '<i8')]
 REFRESH_FINANCIALS = False
+DELTA_REFRESH_GRACE_DAYS = 7
+DOWNLOAD_CONCURRENCY = 32
+QUOTE_CACHE = None
+UNIVERSE_STORE = None
+MANIFEST = None
+# Download threads and the report thread of mint.py print to the same stdout
+PRINT_LOCK = Lock()
+# What a caller of load_historic_data() needs from each ticker
+TICKER_QUOTE = 'quote'
+TICKER_HISTORY = 'history'
+TICKER_FIELDS = (TICKER_QUOTE, TICKER_HISTORY)
+# Bisection steps of the --optimize share allocation
+OPTIMIZE_SEARCH_STEPS = 30
+# History and quotes come from HISTORY_BACKEND. Tickers it does not know are loaded from
+# FALLBACK_BACKEND instead; the universe store records which backend each ticker came from.
+HISTORY_BACKEND = get_backend('yahoo')
+FALLBACK_BACKEND = get_backend('google')
 
 ############## UTILITY FUNCTIONS ##############
 def get_ratio(now, base):
@@ -32,6 +63,24 @@ def get_ratio(now, base):
 def get_ratio_percent(now, base):
     return "{0:.2f}%".format(get_ratio(now, base) * 100)
 
+def to_float_array(values):
+    '''Parse a column of strings into float64, using NaN for missing values (e.g. empty or dash)'''
+    try:
+        return np.array(values, dtype=np.float64)
+    except ValueError:
+        column = np.full(len(values), np.nan)
+        for index, value in enumerate(values):
+            try:
+                column[index] = float(value)
+            except ValueError:
+                pass
+        return column
+
+def get_price_swing_ratios(high, low):
+    '''Vectorized get_ratio(high, low), zero where either price is missing'''
+    is_valid = (high > 0) & (low > 0)
+    return np.where(is_valid, (high - low) / np.where(is_valid, low, 1.0), 0.0)
+
 def get_today():
     return datetime.today()
 
@@ -48,69 +97,187 @@ def modification_date(filename):
     t = os.path.getmtime(filename)
     return datetime.fromtimestamp(t).strftime("%Y-%m-%d")
 
-def get_output_folder():
-    return os.path.join("D:\\", 'data', 'stocks', 'db')
-
-def initialize(refresh_financials=False):
-    global REFRESH_FINANCIALS
+def initialize(refresh_financials=False, quote_ttl=QUOTE_CACHE_TTL, backend_name='yahoo', backend_url=None):
+    '''
+    The default 'yahoo' backend falls back to Google; any other backend is used on its own.
+    '''
+    global REFRESH_FINANCIALS, QUOTE_CACHE, HISTORY_BACKEND, FALLBACK_BACKEND, UNIVERSE_STORE, MANIFEST
     REFRESH_FINANCIALS = refresh_financials
+    HISTORY_BACKEND = get_backend(backend_name, backend_url)
+    FALLBACK_BACKEND = get_backend('google') if backend_name == 'yahoo' else None
     directory = get_output_folder()
     if not os.path.exists(directory):
         os.makedirs(directory)
+    # --refresh also skips cached quotes, but still stores the new ones for later runs
+    QUOTE_CACHE = QuoteCache(get_quote_cache_file(), 0 if refresh_financials else quote_ttl)
+    UNIVERSE_STORE = UniverseStore(get_universe_store_file())
+    MANIFEST = DataManifest(get_manifest_file())
+
+def get_quote_cache_file():
+    return os.path.join(get_output_folder(), "quotes.db")
+
+def get_timings_file(name):
+    return os.path.join(get_output_folder(), "{}-timings.json".format(name))
+
+def get_profile_file(name):
+    return os.path.join(get_output_folder(), "{}.prof".format(name))
 
 def get_historical_data_csv_file(ticker_symbol):
     return os.path.join(get_output_folder(), ticker_symbol + ".csv")
 
-def make_url(ticker_symbol):
-    base_url = "http://ichart.finance.yahoo.com/table.csv?s="
-    return base_url + ticker_symbol
-
 def get_google_site_flag(ticker_symbol):
+    '''Flag file that marked tickers loaded from FALLBACK_BACKEND before the manifest'''
     return get_historical_data_csv_file(ticker_symbol) + '-google'
 
+def get_manifest_file():
+    return os.path.join(get_output_folder(), "manifest.json")
+
+def get_manifest():
+    '''Freshness and source of the history of every ticker (see manifest.py)'''
+    global MANIFEST
+    if not MANIFEST or MANIFEST.get_file() != get_manifest_file():
+        MANIFEST = DataManifest(get_manifest_file())
+    return MANIFEST
+
+def migrate_manifest_entry(ticker_symbol):
+    '''
+    Add the CSV of ticker_symbol downloaded before the manifest, dated by its modification
+    time, and drop its flag file
+    @return: the new manifest entry, or None without a CSV
+    '''
+    csv_file = get_historical_data_csv_file(ticker_symbol)
+    if not os.path.exists(csv_file):
+        return None
+    google_site_flag = get_google_site_flag(ticker_symbol)
+    source = 'google' if os.path.exists(google_site_flag) else get_universe_store().get_source(ticker_symbol) or HISTORY_BACKEND.name
+    get_manifest().update(ticker_symbol, source=source, fetched=os.path.getmtime(csv_file), **get_csv_fingerprint(csv_file))
+    try:
+        os.remove(google_site_flag)
+    except OSError:
+        pass
+    return get_manifest().get(ticker_symbol)
+
+def get_ticker_source(ticker_symbol):
+    '''@return: name of the backend the history of ticker_symbol came from, or None if unknown'''
+    entry = get_manifest().get(ticker_symbol)
+    if entry:
+        return entry['source']
+    return get_universe_store().get_source(ticker_symbol)
+
+def get_ticker_backend(ticker_symbol):
+    if FALLBACK_BACKEND and get_ticker_source(ticker_symbol) == FALLBACK_BACKEND.name:
+        return FALLBACK_BACKEND
+    return HISTORY_BACKEND
+
 def touch_file(flag_filename):
     with open(flag_filename, "w") as f:
         f.write("")
     print ("Touched file: {}".format(flag_filename))
 
+def get_universe_store_file():
+    return os.path.join(get_output_folder(), "universe.bars")
+
+def get_universe_store():
+    '''Container of the parsed bars and the source of every ticker (see universe_store.py)'''
+    global UNIVERSE_STORE
+    if not UNIVERSE_STORE or UNIVERSE_STORE.get_file() != get_universe_store_file():
+        UNIVERSE_STORE = UniverseStore(get_universe_store_file())
+    return UNIVERSE_STORE
+
+def is_stored_bars_current(info, entry):
+    '''@return: True if the stored bars (info of the universe store) were parsed from the CSV of the manifest entry'''
+    if not info or info['rows'] is None:
+        return False
+    return not entry or info['checksum'] == entry.get('checksum')
+
+def compact_universe_store():
+    store = get_universe_store()
+    if store.get_stale_ratio() > COMPACT_STALE_RATIO:
+        with timed('compact'):
+            store.compact()
+
 class HistoricCsvFile:
     '''
     API for a set of historic data points in CSV file format
+
+    Each column is parsed once into a typed numpy array (Date as datetime64[D],
+    prices as float64 and Volume as int64) instead of one dict of strings per row.
+    The parsed columns are added to the universe store the first time a (re)downloaded
+    CSV is read; later runs read them from the store's memory map instead of the text.
+    Processes reading the same bars share the pages of that memory map.
     '''
     def __init__(self, ticker_symbol):
-        self._data_set = []
-        self._headers = []
-        self._is_from_google = os.path.exists(get_google_site_flag(ticker_symbol))
-        with open(get_historical_data_csv_file(ticker_symbol), mode='r') as infile:
+        store = get_universe_store()
+        entry = get_manifest().get(ticker_symbol)
+        info = store.get_info(ticker_symbol)
+        source = entry['source'] if entry else info and info['source']
+        self._is_from_google = source == 'google'
+        if not is_stored_bars_current(info, entry):
+            with timed('parse_csv', ticker_symbol):
+                self._columns = self._parse_csv_file(get_historical_data_csv_file(ticker_symbol))
+                self._sort_by_date()
+                store.put(ticker_symbol, source or HISTORY_BACKEND.name, self._columns, HISTORIC_COLUMN_TYPES, entry and entry.get('checksum'))
+        else:
+            with timed('load_bars', ticker_symbol):
+                self._columns = store.get_columns(ticker_symbol)
+
+    def _parse_csv_file(self, csv_file):
+        headers = []
+        with open(csv_file, mode='r') as infile:
             reader = csv.reader(infile)
-            for row in reader:
-                if self._headers:
-                    mydict = dict()
-                    row_size = len(row)
-                    for col_index in range(len(self._headers)):
-                        if col_index < row_size:
-                            mydict[self._headers[col_index]] = row[col_index]
-                    self._data_set.append(mydict)
-                else:
-                    for column in row:
-                        header_name = column.replace(" ", "_")
-                        if self._is_from_google and header_name == 'Close':
-                            # Google Close is already adjusted.
-                            header_name = 'Adj_Close'
-                        self._headers.append(header_name)
-        if not self._is_from_google:
-            self._data_set.reverse() # sort from oldest to newest
+            for column in next(reader, []):
+                header_name = column.replace(" ", "_")
+                if self._is_from_google and header_name == 'Close':
+                    # Google Close is already adjusted.
+                    header_name = 'Adj_Close'
+                headers.append(header_name)
+            raw_columns = list(zip_longest(*[row for row in reader if row], fillvalue=''))
+        raw_data = dict(zip(headers, raw_columns))
+        row_count = len(raw_columns[0]) if raw_columns else 0
+        columns = dict()
+        columns['Date'] = np.array(raw_data.get('Date', ()), dtype='datetime64[D]')
+        for name in HISTORIC_PRICE_COLUMNS:
+            columns[name] = to_float_array(raw_data[name]) if name in raw_data else np.full(row_count, np.nan)
+        volume = to_float_array(raw_data.get('Volume', [''] * row_count))
+        columns['Volume'] = np.nan_to_num(volume).astype(np.int64)
+        return columns
+
+    def _sort_by_date(self):
+        '''Sort from oldest to newest so the Date column can be used as a binary search index'''
+        dates = self._columns['Date']
+        if len(dates) > 1 and dates[0] > dates[-1]:
+            # Yahoo lists the newest date first
+            self._columns = {name: column[::-1] for name, column in self._columns.items()}
+            dates = self._columns['Date']
+        if np.any(dates[1:] < dates[:-1]):
+            order = np.argsort(dates, kind='stable')
+            self._columns = {name: column[order] for name, column in self._columns.items()}
+        self._columns = {name: np.ascontiguousarray(column) for name, column in self._columns.items()}
 
     def is_google_data(self):
         return self._is_from_google
 
-    def get_historical(self, start_date):
+    def get_columns(self):
+        return self._columns
+
+    def get_indicators(self):
+        return get_indicators([self])[0]
+
+    def get_index_range(self, start_date, end_date=None):
+        '''Binary search the sorted Date column for [start_date, end_date] (both inclusive)'''
+        dates = self._columns['Date']
+        start_index = int(dates.searchsorted(np.datetime64(start_date), side='left'))
+        end_index = int(dates.searchsorted(np.datetime64(end_date), side='right')) if end_date else len(dates)
+        return (start_index, max(start_index, end_index))
+
+    def get_historical(self, start_date, end_date=None):
         """
         @brief Get Yahoo Finance Stock historical price range.
         @param start_date (must be earlier than end_date): string date in format '2009-09-26'
         @param end_date (must be later than start_date): string date in format '2016-09-26'.
                         None means end_date is today.
-        @return: list of data sorted from earliest to latest historical data
+        @return: dict of column arrays sorted from earliest to latest historical data.
+                 The arrays are views into the file's columns, not copies.
 
         Keys are:
             Date
@@ -121,65 +288,171 @@ class HistoricCsvFile:
             Volume
             Adj_Close
         """
-        start_i = start_date.split('-')
-        data_subset = []
-        include_me = False
-        for data in self._data_set:
-            if include_me:
-                data_subset.append(data)
-            else:
-                curr_i = data['Date'].split('-')
-                if start_i[0] <= curr_i[0] and start_i[1] <= curr_i[1] and start_i[2] <= curr_i[2]:
-                    include_me = True
-                    data_subset.append(data)
-        return data_subset
+        (start_index, end_index) = self.get_index_range(start_date, end_date)
+        return {name: column[start_index:end_index] for name, column in self._columns.items()}
 
 class HistoricDataPoint:
     '''
     API for a particular historic data point
     '''
-    def __init__(self, data):
-        self._data = data
+    def __init__(self, data_set, index):
+        self._data_set = data_set
+        self._index = index
 
     def get_date(self):
-        return self._data['Date']
+        return str(self._data_set['Date'][self._index])
 
     def get_closing_price(self):
-        return float(self._data['Adj_Close'])
+        return float(self._data_set['Adj_Close'][self._index])
 
     def get_price_swing_ratio(self):
-        return get_ratio(self._data['High'], self._data['Low']) if self._data['High'] and self._data['Low'] else 0
+        high = self._data_set['High'][self._index]
+        low = self._data_set['Low'][self._index]
+        return get_ratio(high, low) if high > 0 and low > 0 else 0
+
+class HistoricWindowStats:
+    '''
+    Statistics of the days_to_subtract most recent days of a HistoricCsvFile
+    '''
+    def __init__(self, days_to_subtract, start_index, size):
+        self.days_to_subtract = days_to_subtract
+        self.start_index = start_index
+        self.size = size
+        self.first_date = None
+        self.first_closing_price = None
+        self.moving_average = None
+        self.swing_min = None
+        self.swing_max = None
+        self.swing_avg = None
+
+    def to_record(self):
+        '''Plain tuple of the stats, cheap to pickle between processes'''
+        return (self.days_to_subtract, self.start_index, self.size, self.first_date, self.first_closing_price,
+                self.moving_average, self.swing_min, self.swing_max, self.swing_avg)
+
+def window_stats_from_record(record):
+    stats = HistoricWindowStats(*record[:3])
+    (stats.first_date, stats.first_closing_price, stats.moving_average, stats.swing_min, stats.swing_max, stats.swing_avg) = record[3:]
+    return stats
+
+def get_window_stats(csv_data, windows_days):
+    '''
+    Compute the stats of several windows in a single pass over the data.
+
+    Every window ends on the newest date, so each one is a suffix of the columns:
+    suffix sums give the moving averages and reversed running min/max give the day
+    swing extremes of all windows at once. The cost is one pass over the longest window.
+    @return: list of HistoricWindowStats in the order of windows_days
+    '''
+    columns = csv_data.get_columns()
+    row_count = len(columns['Date'])
+    start_indices = [csv_data.get_index_range(get_today_minus_days_string(days))[0] for days in windows_days]
+    first_index = min(start_indices) if start_indices else row_count
+    closes = columns['Adj_Close'][first_index:]
+    swing = get_price_swing_ratios(columns['High'][first_index:], columns['Low'][first_index:])
+    close_sums = np.cumsum(np.nan_to_num(closes)[::-1])[::-1]
+    close_counts = np.cumsum(~np.isnan(closes)[::-1])[::-1]
+    swing_sums = np.cumsum(swing[::-1])[::-1]
+    swing_mins = np.minimum.accumulate(swing[::-1])[::-1]
+    swing_maxs = np.maximum.accumulate(swing[::-1])[::-1]
+    all_stats = []
+    for days, start_index in zip(windows_days, start_indices):
+        stats = HistoricWindowStats(days, start_index, row_count - start_index)
+        if stats.size:
+            i = start_index - first_index
+            stats.first_date = str(columns['Date'][start_index])
+            stats.first_closing_price = float(closes[i])
+            stats.moving_average = float(close_sums[i] / close_counts[i]) if close_counts[i] else float('nan')
+            stats.swing_min = float(swing_mins[i])
+            stats.swing_max = float(swing_maxs[i])
+            stats.swing_avg = float(swing_sums[i] / stats.size)
+        all_stats.append(stats)
+    return all_stats
+
+class HistoricSummary:
+    '''
+    Stand-in for a HistoricCsvFile parsed in another process: the data source, the
+    window stats and the indicators of print_ticker_info(), without the price columns
+    '''
+    def __init__(self, ticker_symbol, is_from_google, window_stats, indicators):
+        self._ticker_symbol = ticker_symbol
+        self._is_from_google = is_from_google
+        self._window_stats = window_stats
+        self._indicators = indicators
+
+    def get_ticker_symbol(self):
+        return self._ticker_symbol
+
+    def is_google_data(self):
+        return self._is_from_google
+
+    def get_window_stats(self):
+        return self._window_stats
+
+    def get_indicators(self):
+        return self._indicators
+
+    def to_record(self):
+        return (self._ticker_symbol, self._is_from_google, [stats.to_record() for stats in self._window_stats], self._indicators)
+
+def historic_summary_from_record(record):
+    (ticker_symbol, is_from_google, stats_records, indicators) = record
+    return HistoricSummary(ticker_symbol, is_from_google, [window_stats_from_record(stats) for stats in stats_records], indicators)
+
+def get_indicators(csv_data_list):
+    '''
+    Latest indicators of many tickers in one pass over their stacked prices (see indicators.py),
+    the same as computed for each ticker on its own
+    @return: list of dict of indicator name -> value, in the order of csv_data_list
+    '''
+    latest = get_latest_indicators(stack_latest_bars([csv_data.get_columns() for csv_data in csv_data_list]))
+    return [{name: float(latest[name][i]) for name in INDICATOR_NAMES} for i in range(len(csv_data_list))]
+
+def get_risk_cache_folder():
+    return os.path.join(get_output_folder(), 'risk')
+
+def get_ticker_covariance(tickers):
+    '''
+    Covariance of the daily returns of tickers (in their order) over the last RISK_DAYS dates,
+    cached per list of tickers and updated with the new bars (see risk.py)
+    '''
+    (dates, matrix) = stack_prices([ticker.get_csv_data().get_columns() for ticker in tickers])
+    with timed('covariance'):
+        return CovarianceCache(get_risk_cache_folder()).get_covariance([ticker.get_name() for ticker in tickers], dates[1:], get_returns(matrix))
+
+def get_ticker_indicators(tickers):
+    '''@return: dict of ticker symbol -> dict of indicator name -> value, for the tickers with history'''
+    tickers = [ticker for ticker in tickers if ticker.get_csv_data()]
+    return {ticker.get_name(): indicators for ticker, indicators in zip(tickers, get_indicators([ticker.get_csv_data() for ticker in tickers]))}
+
+def print_indicators(indicators):
+    print (" > Indicators: EMA({}) ${:.2f}, RSI({}) {:.1f}, Volatility({}) {:.2f}%, Bollinger({}) ${:.2f} - ${:.2f}, Max drawdown {:.2f}%".format(
+                                                                EMA_DAYS, indicators['ema'], RSI_DAYS, indicators['rsi'],
+                                                                VOLATILITY_DAYS, 100*indicators['volatility'],
+                                                                BOLLINGER_DAYS, indicators['bollinger_lower'], indicators['bollinger_upper'],
+                                                                100*indicators['max_drawdown']))
 
 class HistoricDataSetView:
     '''
     API for a subset of historic data points
     '''
-    def __init__(self, ticker, csv_data, days_to_subtract):
+    def __init__(self, ticker, csv_data, days_to_subtract, window_stats=None):
         self._ticker = ticker
+        self._csv_data = csv_data
         self._days_to_subtract = days_to_subtract
-        self._data_set = [HistoricDataPoint(data) for data in csv_data.get_historical(get_today_minus_days_string(self._days_to_subtract))]
-        if not self._data_set:
+        self._stats = window_stats if window_stats else get_window_stats(csv_data, [days_to_subtract])[0]
+        if not self._stats.size:
             print (" > {}:     Data is missing from {}!".format(self._get_stats_title(), get_today_minus_days_string(self._days_to_subtract)))
 
     def _get_ith_day_closing_price(self, ith_day):
         '''Zero-based index from oldest to newest date'''
-        return self._data_set[ith_day].get_closing_price()
+        return HistoricDataPoint(self._csv_data.get_columns(), self._stats.start_index + ith_day).get_closing_price()
 
     def _get_price_swing_ratio(self):
-        min = None
-        max = None
-        sum = 0
-        for ps in [x.get_price_swing_ratio() for x in self._data_set]:
-            sum += ps
-            if not min or ps < min:
-                min = ps
-            if not max or ps > max:
-                max = ps
-        return ["{0:.2f}%".format(min*100), "{0:.2f}%".format(max*100), "{0:.2f}%".format(100*(sum / len(self._data_set)))]
+        return ["{0:.2f}%".format(self._stats.swing_min*100), "{0:.2f}%".format(self._stats.swing_max*100), "{0:.2f}%".format(100*self._stats.swing_avg)]
 
     def _get_moving_average(self):
-        sum = reduce(lambda x, y: x + y, [x.get_closing_price() for x in self._data_set])
-        return sum / len(self._data_set)
+        return self._stats.moving_average
 
     def _get_stats_title(self):
         count = self._days_to_subtract
@@ -194,7 +467,7 @@ class HistoricDataSetView:
         return "{} {}".format(count, measure)
 
     def print_stats(self, moving_average=None, percent_change_moving_average=None):
-        if not self._data_set:
+        if not self._stats.size:
             return
         if not moving_average:
             moving_average = self._get_moving_average()
@@ -205,22 +478,60 @@ class HistoricDataSetView:
                                                                 self._get_stats_title(),
                                                                 percent_change_moving_average,
                                                                 "${0:.2f}".format(float(moving_average)),
-                                                                self._data_set[0].get_date(),
-                                                                get_ratio_percent(self._ticker.get_last_price(), self._data_set[0].get_closing_price()),
-                                                                "${0:.2f}".format(self._data_set[0].get_closing_price()),
+                                                                self._stats.first_date,
+                                                                get_ratio_percent(self._ticker.get_last_price(), self._stats.first_closing_price),
+                                                                "${0:.2f}".format(self._stats.first_closing_price),
                                                                 price_swing[0], price_swing[1], price_swing[2]))
 
+def get_quotes(ticker_symbols):
+    '''
+    Fetch the live quotes of ticker_symbols in batches from the backend their history came from,
+    skipping the symbols that are still fresh in the shared quote cache
+    @return: dict of ticker_symbol -> quote to pass to TickerData
+    '''
+    symbols_by_backend = dict()
+    for ticker_symbol in ticker_symbols:
+        symbols_by_backend.setdefault(get_ticker_backend(ticker_symbol), []).append(ticker_symbol)
+    quotes = dict()
+    for backend, backend_symbols in symbols_by_backend.items():
+        with timed('quotes_' + backend.name):
+            quotes.update(backend.get_quotes(backend_symbols, QUOTE_CACHE))
+    return quotes
+
+def print_quote_cache_summary():
+    if QUOTE_CACHE:
+        print (QUOTE_CACHE.get_summary())
+
+def create_tickers(ticker_symbols, fields=TICKER_FIELDS):
+    '''TickerData of each symbol, hydrated from batched quotes (and with its history loaded if in fields)'''
+    quotes = get_quotes(ticker_symbols)
+    ticker_list = [TickerData(ticker_symbol, quotes.get(ticker_symbol)) for ticker_symbol in ticker_symbols]
+    if TICKER_HISTORY in fields:
+        for ticker in ticker_list:
+            ticker.get_csv_data()
+    return ticker_list
+
 class TickerData:
-    def __init__(self, ticker_symbol):
+    def __init__(self, ticker_symbol, quote=None, csv_data=None):
+        '''
+        quote comes from get_quotes(); without it the quote is requested for this symbol alone.
+        csv_data is the already loaded data of ticker_symbol (e.g. a HistoricSummary); without
+        it the history is only loaded on the first get_csv_data() call.
+        '''
         self._name = ticker_symbol
         self._yahoo = None
         self._google = None
-        self._csv_data = HistoricCsvFile(ticker_symbol)
-        if self._csv_data.is_google_data():
-            self._google = googlefinance.getQuotes(ticker_symbol)[0]
+        self._csv_data = csv_data
+        backend = get_ticker_backend(ticker_symbol)
+        if not quote:
+            with timed('quote_' + backend.name, ticker_symbol):
+                quote = backend.get_quote(ticker_symbol)
+        # Quotes come in the format of the backend the history came from (see get_quotes)
+        if backend.name == 'google':
+            self._google = quote
             #print (json.dumps(self._google, indent=2))
         else:
-            self._yahoo = Share(ticker_symbol)
+            self._yahoo = quote
 
     def get_name(self):
         return self._name
@@ -247,29 +558,49 @@ class TickerData:
         return self._yahoo
 
     def get_csv_data(self):
+        if not self._csv_data:
+            self._csv_data = HistoricCsvFile(self._name)
         return self._csv_data
 
-def print_ticker_info(ticker):
+def get_ticker_info_windows():
     global MAX_ALLOWED_DAYS_TO_SUBTRACT
+    return [50, 200, 365, MAX_ALLOWED_DAYS_TO_SUBTRACT]
+
+def print_locked(message):
+    '''print() for threads sharing stdout with the reports of print_ticker_info'''
+    with PRINT_LOCK:
+        print (message)
+
+def print_ticker_info(ticker, window_stats=None, indicators=None):
+    '''@param indicators: from get_ticker_indicators() when computed for many tickers at once'''
     ticker_symbol = ticker.get_name()
     yahoo = ticker.get_yahoo()
     csv_data = ticker.get_csv_data()
-    print ("Ticker: {} ({})".format(ticker_symbol.upper(), ticker.get_long_name()))
-    print (" > Last price: ${}".format(ticker.get_last_price()))
-    print (" > Last trade: {}".format(ticker.get_last_trade_datetime()))
-    print (" > Open:       {} @ {} / ${}".format(ticker.get_percent_change(), ticker.get_price_change(), ticker.get_price_open()))
-    HistoricDataSetView(ticker, csv_data, 50).print_stats(yahoo.get_50day_moving_avg() if yahoo else None,
-                                                          yahoo.get_percent_change_from_50_day_moving_average() if yahoo else None)
-    HistoricDataSetView(ticker, csv_data, 200).print_stats(yahoo.get_200day_moving_avg() if yahoo else None,
-                                                           yahoo.get_percent_change_from_200_day_moving_average() if yahoo else None)
-    HistoricDataSetView(ticker, csv_data, 365).print_stats()
-    HistoricDataSetView(ticker, csv_data, MAX_ALLOWED_DAYS_TO_SUBTRACT).print_stats()
-    if yahoo:
-        print (" > Year high:  {} @ ${}".format(yahoo.get_percent_change_from_year_high(), yahoo.get_year_high()))
-        print (" > Year low:   {} @ ${}".format(yahoo.get_percent_change_from_year_low(), yahoo.get_year_low()))
-        if yahoo.get_short_ratio():
-            print (" > Short:       {} @ {}".format(yahoo.get_short_ratio(), get_ratio_percent(yahoo.get_volume(), yahoo.get_avg_daily_volume()) if yahoo.get_volume() and yahoo.get_avg_daily_volume() else 'Missing volume'))
-            print (" > P/E:         {} @ (Growth: {}, Earning: {})".format(yahoo.get_price_earnings_ratio(), yahoo.get_price_earnings_growth_ratio(), yahoo.get_earnings_share()))
+    if not window_stats:
+        with timed('stats', ticker_symbol):
+            window_stats = get_window_stats(csv_data, get_ticker_info_windows())
+    if not indicators:
+        with timed('indicators', ticker_symbol):
+            indicators = csv_data.get_indicators()
+    with PRINT_LOCK:
+        print ("Ticker: {} ({})".format(ticker_symbol.upper(), ticker.get_long_name()))
+        print (" > Last price: ${}".format(ticker.get_last_price()))
+        print (" > Last trade: {}".format(ticker.get_last_trade_datetime()))
+        print (" > Open:       {} @ {} / ${}".format(ticker.get_percent_change(), ticker.get_price_change(), ticker.get_price_open()))
+        (stats_50_day, stats_200_day, stats_1_year, stats_max) = window_stats
+        HistoricDataSetView(ticker, csv_data, 50, stats_50_day).print_stats(yahoo.get_50day_moving_avg() if yahoo else None,
+                                                                            yahoo.get_percent_change_from_50_day_moving_average() if yahoo else None)
+        HistoricDataSetView(ticker, csv_data, 200, stats_200_day).print_stats(yahoo.get_200day_moving_avg() if yahoo else None,
+                                                                              yahoo.get_percent_change_from_200_day_moving_average() if yahoo else None)
+        HistoricDataSetView(ticker, csv_data, 365, stats_1_year).print_stats()
+        HistoricDataSetView(ticker, csv_data, stats_max.days_to_subtract, stats_max).print_stats()
+        print_indicators(indicators)
+        if yahoo:
+            print (" > Year high:  {} @ ${}".format(yahoo.get_percent_change_from_year_high(), yahoo.get_year_high()))
+            print (" > Year low:   {} @ ${}".format(yahoo.get_percent_change_from_year_low(), yahoo.get_year_low()))
+            if yahoo.get_short_ratio():
+                print (" > Short:       {} @ {}".format(yahoo.get_short_ratio(), get_ratio_percent(yahoo.get_volume(), yahoo.get_avg_daily_volume()) if yahoo.get_volume() and yahoo.get_avg_daily_volume() else 'Missing volume'))
+                print (" > P/E:         {} @ (Growth: {}, Earning: {})".format(yahoo.get_price_earnings_ratio(), yahoo.get_price_earnings_growth_ratio(), yahoo.get_earnings_share()))
 
     # ========= Old stuff ========= #
     # realtime = Stock(ticker_symbol)
@@ -287,50 +618,183 @@ def split_into_sublists(seq, num):
         last += avg
     return out
 
-def load_historic_data_for_subset(thread_id, ticker_symbols, ticker_queue, unknown_queue):
+def is_same_bar(row, other_row):
+    '''Compare two CSV rows by value, so the number formatting of the source does not matter'''
+    (values, other_values) = (row.split(','), other_row.split(','))
+    if len(values) != len(other_values) or values[0] != other_values[0]:
+        return False
+    try:
+        return all(math.isclose(float(value), float(other_value), rel_tol=1e-6) for value, other_value in zip(values[1:], other_values[1:]))
+    except ValueError:
+        return False
+
+def append_historic_data(ticker_symbol, delta_file, last_date):
+    '''
+    Append the rows of delta_file dated after last_date to the CSV of ticker_symbol.
+    delta_file starts on last_date, and its bar of last_date must match the stored one: after
+    a split or a dividend the source restates every earlier price, and appending to the old
+    ones would leave a jump in the history.
+    The CSV is rewritten through a temporary file and replaced in one step, so readers
+    never see a partially appended file.
+    @return: number of appended rows, or None if delta_file does not have the same columns
+             or restates the bar of last_date
+    '''
+    output_file = get_historical_data_csv_file(ticker_symbol)
+    with open(output_file, mode='r') as infile:
+        header = infile.readline()
+        stored_rows = [line.rstrip('\n') for line in infile if line.startswith(last_date + ',')]
+    with open(delta_file, mode='r') as infile:
+        if infile.readline().strip() != header.strip():
+            return None
+        # Dates are ISO formatted, so string comparison is chronological
+        delta_rows = [line.rstrip('\n') for line in infile if line.strip() and line.split(',', 1)[0] >= last_date]
+    if not delta_rows:
+        return 0
+    overlap_rows = [row for row in delta_rows if row.split(',', 1)[0] == last_date]
+    if not overlap_rows or not stored_rows or not is_same_bar(overlap_rows[0], stored_rows[0]):
+        return None
+    rows = [row for row in delta_rows if row.split(',', 1)[0] > last_date]
+    if not rows:
+        return 0
+    # Per process, since the accounts and mint.py can refresh the same ticker at once
+    temp_file = "{}.{}.tmp".format(output_file, os.getpid())
+    shutil.copyfile(output_file, temp_file)
+    with open(temp_file, mode='r+') as outfile:
+        outfile.seek(0, os.SEEK_END)
+        if outfile.tell() > len(header):
+            outfile.seek(outfile.tell() - 1)
+            if outfile.read(1) != '\n':
+                outfile.write('\n')
+        outfile.write('\n'.join(rows) + '\n')
+    os.replace(temp_file, output_file)
+    return len(rows)
+
+async def update_historic_data_delta(pool, ticker_symbol, entry):
+    '''
+    Download only the bars from the last date in the manifest entry of ticker_symbol on and
+    append the new ones (see append_historic_data). When the source cannot be reached, the
+    stored data is used as is and the entry is not marked as fetched, so the next run retries.
+    @return: True if the stored data can be used, False if a full download is needed
+    '''
+    last_date = entry.get('last_date')
+    if not last_date:
+        return False
+    output_file = get_historical_data_csv_file(ticker_symbol)
+    start_date = datetime.strptime(last_date, "%Y-%m-%d")
+    if start_date + timedelta(days=1) > get_today():
+        get_manifest().update(ticker_symbol, fetched=time.time())
+        return True
+    delta_file = "{}.{}.delta".format(output_file, os.getpid())
+    appended_rows = None
+    (is_downloaded, is_rejected) = (False, False)
+    try:
+        backend = get_ticker_backend(ticker_symbol)
+        with timed('delta_' + backend.name, ticker_symbol):
+            await backend.download_history(pool, ticker_symbol, delta_file, start_date)
+        is_downloaded = True
+        appended_rows = append_historic_data(ticker_symbol, delta_file, last_date)
+    except HttpError as e:
+        is_rejected = 400 <= e.status < 500
+        if is_rejected and start_date + timedelta(days=1) > get_today_minus_days(DELTA_REFRESH_GRACE_DAYS):
+            # Sources reject ranges without trading days (e.g. over a weekend)
+            appended_rows = 0
+    except Exception:
+        pass
+    finally:
+        try:
+            os.remove(delta_file)
+        except OSError:
+            pass
+    if appended_rows is None and not is_downloaded and not is_rejected:
+        # Network error, timeout or server error: keep the stored bars, still due for a refresh
+        print_locked ("INFO: Could not refresh {}, using the stored data".format(ticker_symbol))
+        return True
+    if appended_rows is None:
+        return False
+    if appended_rows:
+        # The new checksum makes HistoricCsvFile parse the extended CSV again
+        update_manifest_entry(ticker_symbol, entry['source'])
+        print_locked ("Appended {} rows to {}".format(appended_rows, output_file))
+    else:
+        get_manifest().update(ticker_symbol, fetched=time.time())
+    return True
+
+def update_manifest_entry(ticker_symbol, source_name):
+    '''Record the CSV of ticker_symbol as fetched now; stored bars of another CSV are dropped'''
+    entry = get_manifest().get(ticker_symbol)
+    fingerprint = get_csv_fingerprint(get_historical_data_csv_file(ticker_symbol))
+    get_manifest().update(ticker_symbol, source=source_name, fetched=time.time(), **fingerprint)
+    if not entry or entry.get('checksum') != fingerprint['checksum']:
+        # Processes that loaded the manifest earlier see the change in the universe store
+        get_universe_store().put_source(ticker_symbol, source_name)
+
+async def update_historic_data(pool, ticker_symbol):
+    '''
+    Refresh the CSV of ticker_symbol unless the manifest says it was already fetched today.
+    Stored data is extended with the missing bars only; a full download (HISTORY_BACKEND,
+    then FALLBACK_BACKEND) happens for new tickers, with --refresh or when the delta fails.
+    @return: True if data is available for ticker_symbol
+    '''
     global MAX_ALLOWED_DAYS_TO_SUBTRACT, REFRESH_FINANCIALS
-    for ticker_symbol_sublist in split_into_sublists(ticker_symbols, 150):
-        tickers = []
-        for ticker_symbol in ticker_symbol_sublist:
-            output_file = get_historical_data_csv_file(ticker_symbol)
-            is_okay = True
-            if REFRESH_FINANCIALS or not os.path.exists(output_file) or modification_date(output_file) != get_today_string():
-                try:
-                    os.remove(output_file)
-                except OSError:
-                    pass
-                try:
-                    urllib.request.urlretrieve(make_url(ticker_symbol), output_file)
-                except urllib.error.ContentTooShortError as e:
-                    outfile = open(output_file, "w")
-                    outfile.write(e.content)
-                    outfile.close()
-                except:
-                    print ("INFO: No Yahoo data for {}. Trying Google...".format(ticker_symbol))
-                    is_okay = False
-                if not is_okay:
-                    google_site_flag = get_google_site_flag(ticker_symbol)
-                    try:
-                        os.remove(google_site_flag)
-                    except OSError:
-                        pass
-                    try:
-                        start_date = get_today_minus_days(MAX_ALLOWED_DAYS_TO_SUBTRACT)
-                        end_date = get_today()
-                        df = web.DataReader(ticker_symbol, 'google', start_date, end_date)
-                        df.to_csv(output_file)
-                        is_okay = os.path.exists(output_file)
-                    except:
-                        print ("ERROR: No Google data for {}".format(ticker_symbol))
-                    if is_okay:
-                        touch_file(google_site_flag)
-                if is_okay:
-                    print ("({}) Updated {}".format(thread_id, output_file))
-                else:
-                    unknown_queue.put(ticker_symbol)
-            # Add ticker in the queue
-            if is_okay:
-                ticker_queue.put(TickerData(ticker_symbol))
+    output_file = get_historical_data_csv_file(ticker_symbol)
+    entry = get_manifest().get(ticker_symbol) or migrate_manifest_entry(ticker_symbol)
+    if not REFRESH_FINANCIALS and entry:
+        if datetime.fromtimestamp(entry['fetched']).strftime("%Y-%m-%d") == get_today_string():
+            return True
+        if await update_historic_data_delta(pool, ticker_symbol, entry):
+            return True
+    try:
+        os.remove(output_file)
+    except OSError:
+        pass
+    start_date = get_today_minus_days(MAX_ALLOWED_DAYS_TO_SUBTRACT)
+    is_okay = True
+    source = HISTORY_BACKEND
+    try:
+        with timed('download_' + HISTORY_BACKEND.name, ticker_symbol):
+            await HISTORY_BACKEND.download_history(pool, ticker_symbol, output_file, start_date)
+    except Exception:
+        if FALLBACK_BACKEND:
+            print_locked ("INFO: No {} data for {}. Trying {}...".format(HISTORY_BACKEND.title, ticker_symbol, FALLBACK_BACKEND.title))
+        else:
+            print_locked ("ERROR: No {} data for {}".format(HISTORY_BACKEND.title, ticker_symbol))
+        is_okay = False
+    if not is_okay and FALLBACK_BACKEND:
+        try:
+            with timed('download_' + FALLBACK_BACKEND.name, ticker_symbol):
+                await FALLBACK_BACKEND.download_history(pool, ticker_symbol, output_file, start_date)
+            is_okay = os.path.exists(output_file)
+        except Exception:
+            print_locked ("ERROR: No {} data for {}".format(FALLBACK_BACKEND.title, ticker_symbol))
+        source = FALLBACK_BACKEND
+    if is_okay:
+        update_manifest_entry(ticker_symbol, source.name)
+        print_locked ("Updated {}".format(output_file))
+    return is_okay
+
+async def update_all_historic_data(ticker_symbols, ready_callback, unknown_callback, concurrency):
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    pool = AsyncHttpPool(max_idle_per_host=concurrency)
+    async def update(ticker_symbol):
+        async with semaphore:
+            is_okay = await update_historic_data(pool, ticker_symbol)
+        # Callbacks may block (e.g. on quote requests), so keep them off the event loop
+        await loop.run_in_executor(None, ready_callback if is_okay else unknown_callback, ticker_symbol)
+    try:
+        await asyncio.gather(*[update(ticker_symbol) for ticker_symbol in ticker_symbols])
+    finally:
+        await pool.close()
+
+def download_historic_data(ticker_symbols, ready_callback, unknown_callback, concurrency=DOWNLOAD_CONCURRENCY):
+    '''
+    Refresh the historic data of ticker_symbols with at most concurrency downloads in flight,
+    then call ready_callback(ticker_symbol) or unknown_callback(ticker_symbol) for each one
+    '''
+    try:
+        asyncio.run(update_all_historic_data(ticker_symbols, ready_callback, unknown_callback, concurrency))
+    finally:
+        get_manifest().save()
 
 def convert_to_list(myqueue):
     mylist = []
@@ -338,23 +802,129 @@ def convert_to_list(myqueue):
         mylist.append(myqueue.get(False))
     return mylist
 
-def load_historic_data(ticker_symbols):
+def load_historic_data(ticker_symbols, concurrency=DOWNLOAD_CONCURRENCY, fields=TICKER_FIELDS):
+    '''
+    @param fields: what the caller needs from each ticker. Without TICKER_HISTORY, the
+                   tickers with a live quote skip the history download and parsing;
+                   only the others are downloaded (to tell unknown symbols apart).
+    @return: (list of TickerData, list of unknown symbols)
+    '''
     start_time = time.time()
-    mythreads = []
-    thread_id = 0
-    ticker_queue = Queue()
+    ticker_list = []
+    if TICKER_HISTORY not in fields:
+        quotes = get_quotes(ticker_symbols)
+        ticker_list = [TickerData(ticker_symbol, quotes[ticker_symbol]) for ticker_symbol in ticker_symbols if ticker_symbol in quotes]
+        ticker_symbols = [ticker_symbol for ticker_symbol in ticker_symbols if ticker_symbol not in quotes]
+    ready_queue = Queue()
     unknown_queue = Queue()
-    num_threads = 200
-    print ("Loading historic data with {} threads...".format(num_threads))
-    for ticker_symbol_sublist in split_into_sublists(ticker_symbols, num_threads):
-        t = Thread(target=load_historic_data_for_subset, args=(thread_id, ticker_symbol_sublist, ticker_queue, unknown_queue, ))
-        t.start()
-        mythreads.append(t)
-        thread_id += 1
-    for t in mythreads:
-        t.join()
-    print ("CSV load time ({} stocks, {} threads): {}".format(ticker_queue.qsize(), thread_id, time.time()-start_time))
-    return (convert_to_list(ticker_queue), convert_to_list(unknown_queue))
+    if ticker_symbols:
+        print ("Loading historic data with {} concurrent downloads...".format(concurrency))
+        download_historic_data(ticker_symbols, ready_queue.put, unknown_queue.put, concurrency)
+    ticker_list += create_tickers(convert_to_list(ready_queue), fields)
+    unknown_list = convert_to_list(unknown_queue)
+    print ("CSV load time ({} stocks, {} concurrent downloads): {}".format(len(ticker_list), concurrency, time.time()-start_time))
+    print_quote_cache_summary()
+    compact_universe_store()
+    TIMINGS.write_summary(get_timings_file('load_historic_data'), tickers=len(ticker_list), unknown=unknown_list, concurrency=concurrency)
+    return (ticker_list, unknown_list)
+
+def roundoff_array(values):
+    return np.round(values, 3)
+
+def get_drift(prices, shares, target_percents):
+    '''Total drift of holding shares, as a fraction of their balance'''
+    balances = prices*shares
+    total_balance = balances.sum()
+    return float(np.abs(balances/total_balance - target_percents).sum()/2) if total_balance > 0 else float('inf')
+
+def fill_targets(prices, target_percents, target_balance, budget):
+    '''
+    Whole shares closest to target_percents of target_balance that cost at most budget.
+
+    Every holding starts at the most shares that stay under its target. One more share
+    of a holding that is gap under its target puts it price-gap over, so it only helps
+    when gap > price/2, and never twice. The cash left in budget buys those shares from
+    a heap in order of drift reduction, skipping the ones it cannot afford: O(n log n).
+    @return: array of shares, or None if even the shares under the targets cost over budget
+    '''
+    target_balances = target_percents*target_balance
+    shares = np.floor(target_balances/prices).astype(np.int64)
+    cash = budget - float((prices*shares).sum())
+    if cash < 0:
+        return None
+    gains = 2*(target_balances - prices*shares) - prices
+    heap = [(-gain, i) for i, gain in enumerate(gains.tolist()) if gain > 0]
+    heapq.heapify(heap)
+    price_list = prices.tolist()
+    while heap and cash > 0:
+        (_, i) = heapq.heappop(heap)
+        if price_list[i] <= cash:
+            shares[i] += 1
+            cash -= price_list[i]
+    return shares
+
+def get_optimal_shares(prices, target_percents, budget):
+    '''
+    Whole share counts with the least drift that cost at most budget.
+
+    Aiming the targets at budget itself leaves cash over, and the drift is measured
+    against what is actually held. So the targets are also aimed at larger balances:
+    a bisection finds the largest one whose shares still fit the budget in at most
+    OPTIMIZE_SEARCH_STEPS fill_targets() passes, and the plan with the least drift wins.
+    Targets adding up to more than 100% (e.g. rounded percents) are scaled down first,
+    or even the shares under them could cost more than budget.
+    '''
+    target_percents = target_percents/max(float(target_percents.sum()), 1.0)
+    best_shares = fill_targets(prices, target_percents, budget, budget)
+    if best_shares is None:
+        # Only a negative budget affords nothing
+        return np.zeros(len(prices), dtype=np.int64)
+    best_drift = get_drift(prices, best_shares, target_percents)
+    # The shares under the targets cost at least scale*budget*sum(target_percents) - sum(prices)
+    (low, high) = (1.0, (budget + float(prices.sum()))/(budget*max(float(target_percents.sum()), 1e-9)))
+    for _ in range(OPTIMIZE_SEARCH_STEPS):
+        scale = (low + high)/2
+        shares = fill_targets(prices, target_percents, scale*budget, budget)
+        if shares is None:
+            high = scale
+            continue
+        low = scale
+        drift = get_drift(prices, shares, target_percents)
+        if drift < best_drift:
+            (best_shares, best_drift) = (shares, drift)
+    return best_shares
+
+def get_rebalance_plan(prices, shares_held, target_percents, requested_target_balance, optimize=False):
+    '''
+    Rebalance every holding at once: each one is bought or sold to the nearest whole
+    share of its target_percent of requested_target_balance, or with optimize to the
+    shares of get_optimal_shares(). Balances are rounded to 3 decimals like
+    StockAssistant.roundoff().
+    @param prices, shares_held, target_percents: one array element per holding
+    @return: dict of per holding arrays (price, balance_held, target_balance, diff_balance,
+             action_shares, new_shares_held, new_balance, old_drift, new_drift in percent
+             points from the target) and the totals over all holdings
+    '''
+    plan = {'price': prices}
+    plan['balance_held'] = roundoff_array(prices*shares_held)
+    plan['target_balance'] = roundoff_array(target_percents*requested_target_balance)
+    plan['diff_balance'] = roundoff_array(plan['target_balance'] - plan['balance_held'])
+    if optimize:
+        plan['action_shares'] = get_optimal_shares(prices, target_percents, requested_target_balance) - shares_held
+    else:
+        plan['action_shares'] = np.round(plan['diff_balance']/prices).astype(np.int64)
+    plan['new_shares_held'] = shares_held + plan['action_shares']
+    plan['new_balance'] = roundoff_array(prices*plan['new_shares_held'])
+    plan['total_old_holding_balance'] = float(plan['balance_held'].sum())
+    plan['total_new_holding_balance'] = float(plan['new_balance'].sum())
+    plan['total_action_balance'] = float(roundoff_array(prices*plan['action_shares']).sum())
+    with np.errstate(divide='ignore', invalid='ignore'):
+        plan['old_drift'] = 100*plan['balance_held']/plan['total_old_holding_balance'] - 100*target_percents
+        plan['new_drift'] = 100*plan['new_balance']/plan['total_new_holding_balance'] - 100*target_percents
+    # Every over-weight percent point is matched by an under-weight one
+    plan['total_old_drift'] = float(np.abs(plan['old_drift']).sum()/2)
+    plan['total_new_drift'] = float(np.abs(plan['new_drift']).sum()/2)
+    return plan
 
 class StockHolding:
     def __init__(self, target_percent, shares_held):
@@ -368,20 +938,88 @@ class StockAccount:
         self.stocks = None
 
 class StockAssistant:
-    def __init__(self, default_account, requested_increment, requested_target_balance, commit_transaction, refresh_financials):
-        # Load my account
+    def __init__(self, default_account, requested_increment, requested_target_balance, commit_transaction, refresh_financials, quote_ttl=QUOTE_CACHE_TTL,
+                 backend_name='yahoo', backend_url=None, profile=False, optimize=False, as_of=None, risk=False, backtest=None, run=True):
+        '''
+        @param profile: run under cProfile and save the stats next to the market data
+        @param optimize: pick the shares minimizing the drift within the target balance
+        @param as_of: only show the account history and holdings as of this date
+        @param risk: also load the history of the holdings and report the portfolio volatility
+        @param backtest: (rebalance intervals, drift thresholds, cost in basis points per traded dollar)
+                         of the policies to replay over the stored history, instead of rebalancing
+        @param run: False to only set up the assistant (see from_account_store)
+        '''
         self._default_account = default_account
-        self.load_account_data()
-        if requested_increment:
-            requested_target_balance = self._account.balance + float(requested_increment)
-        elif not requested_target_balance:
-            requested_target_balance = self._account.balance
-        requested_target_balance = float(requested_target_balance)
-        # Load stock data from Yahoo and Google Finance
-        initialize(refresh_financials)
-        (ticker_list, unknown_list) = load_historic_data(self.get_default_symbols())
+        self._account = None
+        if not run:
+            return
+        if as_of:
+            self.print_account_history(as_of)
+            return
+        initialize(refresh_financials, quote_ttl, backend_name, backend_url)
+        if backtest:
+            self.backtest(*backtest)
+        elif profile:
+            run_profiled(lambda: self.rebalance(requested_increment, requested_target_balance, commit_transaction, optimize, risk),
+                         get_profile_file(default_account.db_name))
+        else:
+            self.rebalance(requested_increment, requested_target_balance, commit_transaction, optimize, risk)
+        TIMINGS.print_summary()
+        TIMINGS.write_summary(get_timings_file(default_account.db_name), account=default_account.db_name)
+
+    def rebalance(self, requested_increment, requested_target_balance, commit_transaction, optimize=False, risk=False):
+        # Load my account
+        with timed('account'):
+            self.load_account_data()
+        requested_target_balance = self.get_requested_target_balance(requested_increment, requested_target_balance)
+        # Load stock data from the market data backend
+        # Rebalancing only needs the last prices and names; the risk report needs the history
+        (ticker_list, unknown_list) = load_historic_data(self.get_default_symbols(), fields=TICKER_FIELDS if risk else (TICKER_QUOTE, ))
         # Determine what to buy or sell
-        self.determine_transactions(requested_target_balance, ticker_list, commit_transaction)
+        with timed('rebalance'):
+            self.determine_transactions(requested_target_balance, ticker_list, commit_transaction, optimize, risk)
+
+    def backtest(self, intervals, drift_thresholds, cost_bps=0.0):
+        '''Replay the target_percent rebalancing with every combination of intervals and drift_thresholds'''
+        with timed('account'):
+            self.load_account_data()
+        (ticker_list, unknown_list) = load_historic_data(self.get_default_symbols())
+        ticker_list.sort(key=lambda x: x.get_name())
+        (dates, prices) = stack_prices([ticker.get_csv_data().get_columns() for ticker in ticker_list])
+        # Start once every holding has a price
+        complete_dates = np.flatnonzero(~np.isnan(prices).any(axis=0))
+        if not len(complete_dates):
+            print ("ERROR: No date with the prices of every holding")
+            return
+        prices = prices[:, complete_dates[0]:]
+        with timed('backtest'):
+            results = run_backtest(prices, [self._account.stocks[ticker.get_name()].target_percent for ticker in ticker_list],
+                                   *get_policies(intervals, drift_thresholds), cost_rate=cost_bps/10000.0)
+        print_backtest_results(results, dates[complete_dates[0]], dates[-1])
+
+    @classmethod
+    def from_account_store(cls, account_name):
+        '''
+        Assistant of an account already committed to the account store, without loading
+        market data (e.g. for daemon.py, which keeps the tickers loaded)
+        @return: StockAssistant with the account loaded, or None if account_name was never committed
+        '''
+        default_account = StockAccount()
+        default_account.db_name = account_name
+        assistant = cls(default_account, None, None, False, False, run=False)
+        store = AccountStore(assistant.get_account_store_file())
+        has_account = store.has_account(account_name)
+        store.close()
+        if not has_account or not assistant.load_account_data():
+            return None
+        return assistant
+
+    def get_requested_target_balance(self, requested_increment, requested_target_balance):
+        if requested_increment:
+            return self._account.balance + float(requested_increment)
+        if not requested_target_balance:
+            return float(self._account.balance)
+        return float(requested_target_balance)
 
     def get_default_symbols(self):
         return list(self._account.stocks.keys())
@@ -389,58 +1027,58 @@ class StockAssistant:
     def roundoff(self, value):
         return float("{0:.3f}".format(value))
 
-    def determine_transactions(self, requested_target_balance, ticker_list, commit_transaction):
+    def determine_transactions(self, requested_target_balance, ticker_list, commit_transaction, optimize=False, risk=False):
         ticker_list.sort(key=lambda x: x.get_name())
+        names = [ticker.get_name() for ticker in ticker_list]
+        holdings = [self._account.stocks[name] for name in names]
+        old_shares_held = [holding.shares_held for holding in holdings]
+        plan_arrays = (np.array([float(ticker.get_last_price()) for ticker in ticker_list]),
+                       np.array(old_shares_held, dtype=np.int64),
+                       np.array([holding.target_percent for holding in holdings]),
+                       requested_target_balance)
+        plan = get_rebalance_plan(*plan_arrays, optimize=optimize)
+        for holding, shares_held in zip(holdings, plan['new_shares_held'].tolist()):
+            holding.shares_held = shares_held
         buy_shares = []
         sell_shares = []
-        total_old_holding_balance = 0
-        total_new_holding_balance = 0
-        total_action_balance = 0
         db_is_modified = False
-        drift_values = []
+        total_old_holding_balance = plan['total_old_holding_balance']
+        total_new_holding_balance = plan['total_new_holding_balance']
+        total_action_balance = plan['total_action_balance']
 
-        for ticker in ticker_list:
-            price = float(ticker.get_last_price())
-            name = ticker.get_name()
-            shares_held = self._account.stocks[name].shares_held
-            balance_held = self.roundoff(price*shares_held)
-            total_old_holding_balance += balance_held
-            target_balance = self.roundoff(self._account.stocks[name].target_percent*requested_target_balance)
-            raw_diff_balance = self.roundoff(target_balance-balance_held)
+        # The report is generated from the plan arrays
+        rows = zip(ticker_list, names, old_shares_held, *[plan[key].tolist() for key in
+                   ['price', 'balance_held', 'target_balance', 'diff_balance', 'action_shares', 'new_shares_held']])
+        for (ticker, name, shares_held, price, balance_held, target_balance, raw_diff_balance, action_shares, new_shares_held) in rows:
             action = "buy"
-            action_shares = int(round(raw_diff_balance/price))
-            self._account.stocks[name].shares_held += action_shares
-            new_holding_balance = self.roundoff(price*self._account.stocks[name].shares_held)
-            total_new_holding_balance += new_holding_balance
-            drift_values.append((name, balance_held, new_holding_balance))
-            total_action_balance += self.roundoff(price*action_shares)
-            if raw_diff_balance < 0:
+            # An optimized allocation can trade a share past the target balance
+            if action_shares < 0 or (action_shares == 0 and raw_diff_balance < 0):
                 action = "sell"
-                raw_diff_balance = -1*raw_diff_balance
                 action_shares = -1*action_shares
                 if action_shares > 0:
-                    sell_shares.append("{}: Sell {} shares @ ${} (old: {}, new: {})".format(name.upper(), action_shares, price, shares_held, self._account.stocks[name].shares_held))
+                    sell_shares.append("{}: Sell {} shares @ ${} (old: {}, new: {})".format(name.upper(), action_shares, price, shares_held, new_shares_held))
             elif action_shares > 0:
-                buy_shares.append("{}: Buy {} shares @ ${} (old: {}, new: {})".format(name.upper(), action_shares, price, shares_held, self._account.stocks[name].shares_held))
+                buy_shares.append("{}: Buy {} shares @ ${} (old: {}, new: {})".format(name.upper(), action_shares, price, shares_held, new_shares_held))
             print ("{}".format(name.upper()))
             print("> Name: {}".format(ticker.get_long_name()))
             print("> Expected: ${}".format(target_balance))
             print("> Actual: ${} (${} x {})".format(balance_held,
                                                      price,
                                                      shares_held))
-            print("> To {}: ${} ({} shares)".format(action, raw_diff_balance,action_shares))
+            # The value of the traded shares, never negative even when it goes against the diff
+            action_balance = self.roundoff(action_shares*price) if action_shares else abs(raw_diff_balance)
+            print("> To {}: ${} ({} shares)".format(action, action_balance, action_shares))
 
         print("==================== DRIFT ============================")
-        total_old_drift = 0
-        total_new_drift = 0
-        for name, old_holding, new_holding in drift_values:
-            ideal_target_percent = 100*self._account.stocks[name].target_percent
-            old_target_percent = 100*old_holding/total_old_holding_balance
-            total_old_drift += abs(old_target_percent-ideal_target_percent)
-            new_target_percent = 100*new_holding/total_new_holding_balance
-            total_new_drift += abs(new_target_percent-ideal_target_percent)
-            print("{}: new {}%, old {}%".format(name.upper(), self.roundoff(new_target_percent-ideal_target_percent), self.roundoff(old_target_percent-ideal_target_percent)))
-        print("Total: new {}%, old {}%".format(self.roundoff(total_new_drift/2), self.roundoff(total_old_drift/2)))
+        for name, new_drift, old_drift in zip(names, plan['new_drift'].tolist(), plan['old_drift'].tolist()):
+            print("{}: new {}%, old {}%".format(name.upper(), self.roundoff(new_drift), self.roundoff(old_drift)))
+        print("Total: new {}%, old {}%".format(self.roundoff(plan['total_new_drift']), self.roundoff(plan['total_old_drift'])))
+        if optimize:
+            rounded_plan = get_rebalance_plan(*plan_arrays)
+            print("Rounding each holding instead: new {}%, cost over target ${}".format(self.roundoff(rounded_plan['total_new_drift']),
+                                                        "{0:.3f}".format(rounded_plan['total_new_holding_balance']-requested_target_balance)))
+        if risk:
+            self.print_risk(ticker_list, plan)
             
         print("\n================================================")
         action_messages = buy_shares+sell_shares
@@ -450,45 +1088,92 @@ class StockAssistant:
         print("Summary")
         print("> Transactions: {}".format(len(action_messages)))
         print("> Old")
-        print("  > Holdings: ${}".format(total_old_holding_balance))
+        print("  > Holdings: ${}".format(self.roundoff(total_old_holding_balance)))
         print("  > Target: ${}".format(self._account.balance))
         print("  > Cost over holdings: ${}".format("{0:.3f}".format(total_action_balance)))
         print("  > Cost over target: ${}".format("{0:.3f}".format(total_new_holding_balance-self._account.balance)))
         print("> New")
-        print("  > Holdings: ${}".format(total_new_holding_balance))
+        print("  > Holdings: ${}".format(self.roundoff(total_new_holding_balance)))
         print("  > Target: ${}".format(requested_target_balance))
         print("================================================\n")
         # Commit transactions
         if db_is_modified and commit_transaction:
             self._account.balance = requested_target_balance
-            self.write_account_data()
+            self.write_account_data("Rebalanced to ${} ({} transactions)".format(requested_target_balance, len(action_messages)))
         else:
             print("Account database is already up-to-date")
 
+    def print_risk(self, ticker_list, plan):
+        covariance = get_ticker_covariance(ticker_list)
+        volatilities = np.sqrt(np.diag(covariance)*TRADING_DAYS_PER_YEAR)
+        print("==================== RISK =============================")
+        for ticker, volatility in zip(ticker_list, volatilities.tolist()):
+            print("{}: volatility {}%".format(ticker.get_name().upper(), self.roundoff(100*volatility)))
+        print("Portfolio volatility: new {}%, old {}% (annualized, last {} days)".format(
+            self.roundoff(100*get_portfolio_volatility(plan['new_balance']/plan['total_new_holding_balance'], covariance)),
+            self.roundoff(100*get_portfolio_volatility(plan['balance_held']/plan['total_old_holding_balance'], covariance)),
+            RISK_DAYS))
+
     def get_db_file(self):
+        '''Whole-account pickle of older versions, migrated into the account store on first use'''
         return os.path.join(os.path.dirname(os.path.abspath(__file__)), "{}.db".format(self._default_account.db_name))
 
-    def write_account_data(self):
-        output_file = self.get_db_file()
-        start_time = time.time()
-        fileObject = open(output_file,'wb')
-        pickle.dump(self._account, fileObject)
-        fileObject.close()
-        print ("Wrote: {}".format(output_file))
-
-    def load_account_data(self):
-        start_time = time.time()
-        output_file = self.get_db_file()
-        self._account = None
-        if os.path.exists(output_file):
-            fileObject = open(output_file,'rb')
-            self._account = pickle.load(fileObject)
-            print ("Loaded: {}".format(output_file))
-        else:
-            # Default values
-            print ("New account: {}".format(output_file))
-            self._account = self._default_account
-            self.write_account_data()
+    def get_account_store_file(self):
+        return os.path.join(os.path.dirname(os.path.abspath(__file__)), "accounts.sqlite")
+
+    def write_account_data(self, note=None):
+        '''Append the current holdings to the account history'''
+        output_file = self.get_account_store_file()
+        holdings = {symbol: (holding.target_percent, holding.shares_held) for symbol, holding in self._account.stocks.items()}
+        store = AccountStore(output_file)
+        changes = store.commit(self._default_account.db_name, self._account.balance, holdings, note)
+        store.close()
+        print ("Wrote: {} ({}: {} changed holdings)".format(output_file, self._default_account.db_name, changes))
+
+    def load_account_data(self, as_of=None):
+        '''@param as_of: load the account as it was at this date or time instead of the latest commit'''
+        output_file = self.get_account_store_file()
+        name = self._default_account.db_name
+        store = AccountStore(output_file)
+        if not store.has_account(name):
+            if os.path.exists(self.get_db_file()):
+                migrate_pickled_account(store, name, self.get_db_file(), sys.modules[__name__])
+                print ("Migrated: {} to {}".format(self.get_db_file(), output_file))
+            else:
+                # Default values
+                print ("New account: {} ({})".format(output_file, name))
+                self._account = self._default_account
+                self.write_account_data("New account")
+        account = store.get_account(name, as_of)
+        store.close()
+        self._account = StockAccount()
+        self._account.db_name = name
+        self._account.stocks = dict()
+        if not account:
+            print ("No {} account as of {}".format(name, as_of))
+            return False
+        (self._account.balance, holdings, committed_at) = account
+        for symbol, (target_percent, shares_held) in holdings.items():
+            self._account.stocks[symbol] = StockHolding(0, shares_held)
+            self._account.stocks[symbol].target_percent = target_percent
+        print ("Loaded: {} ({} as of {})".format(output_file, name, committed_at))
+        return True
+
+    def print_account_history(self, as_of):
+        '''Commits of the account up to as_of and its holdings at that time'''
+        if not self.load_account_data(as_of):
+            return
+        store = AccountStore(self.get_account_store_file())
+        history = store.get_history(self._default_account.db_name)
+        store.close()
+        print ("==================== HISTORY ===========================")
+        for (committed_at, balance, note, changes) in history:
+            if committed_at <= get_as_of_timestamp(as_of):
+                print ("{}: ${} ({} changed holdings) {}".format(committed_at, balance, changes, note or ''))
+        print ("==================== AS OF {} ====================".format(as_of))
+        print ("Target: ${}".format(self._account.balance))
+        for symbol, holding in sorted(self._account.stocks.items()):
+            print ("{}: {} shares, target {}%".format(symbol.upper(), holding.shares_held, self.roundoff(100*holding.target_percent)))
 
 def process_options():
     parser = argparse.ArgumentParser(description='Analyze ticker_symbol prices.')
@@ -496,5 +1181,19 @@ def process_options():
     parser.add_argument('--target_balance', metavar='BALANCE', help='Target BALANCE to keep in stocks and bonds', default=None)
     parser.add_argument('--commit', action="store_true", help='Commit the transaction (buy/sell stocks and bonds)')
     parser.add_argument('--refresh', action="store_true", help='Refresh stock data)')
+    parser.add_argument('--quote_ttl', metavar='SECONDS', type=int, help='Reuse live quotes cached less than SECONDS ago', default=QUOTE_CACHE_TTL)
+    parser.add_argument('--backend', metavar='NAME', choices=get_backend_names(), help='Market data backend NAME', default='yahoo')
+    parser.add_argument('--backend_url', metavar='URL', help='Base URL of the backend site (e.g. a local fixture_server.py)', default=None)
+    parser.add_argument('--profile', action="store_true", help='Run under cProfile and save the stats to <db_name>.prof in the data folder')
+    parser.add_argument('--as_of', metavar='DATE', help='Show the committed account history and holdings as of DATE (e.g. 2017-05-01) and exit', default=None)
+    parser.add_argument('--optimize', action="store_true", help='Pick the whole shares that minimize the drift within the target BALANCE instead of rounding each holding')
+    parser.add_argument('--risk', action="store_true", help='Report the volatility of the holdings and of the portfolio before and after the transactions')
+    parser.add_argument('--backtest', action="store_true", help='Replay the rebalancing over the stored history with every --intervals and --drift_thresholds pair')
+    parser.add_argument('--intervals', metavar='DAYS', type=int, nargs='+', help='Trading DAYS between rebalance checks for --backtest', default=DEFAULT_INTERVALS)
+    parser.add_argument('--drift_thresholds', metavar='PERCENT', type=float, nargs='+', help='Rebalance when the total drift exceeds PERCENT for --backtest', default=DEFAULT_DRIFT_THRESHOLDS)
+    parser.add_argument('--cost_bps', metavar='BPS', type=float, help='Cost of each traded dollar in basis points for --backtest', default=0.0)
     args = parser.parse_args()
+    if any(interval < 1 for interval in args.intervals):
+        parser.error("--intervals must be at least 1 day")
+    args.backtest = (args.intervals, args.drift_thresholds, args.cost_bps) if args.backtest else None
     return args
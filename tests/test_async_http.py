@@ -0,0 +1,78 @@
+'''AsyncHttpPool and the concurrent history downloads against fixture_server.FixtureServer'''
+import asyncio
+import time
+from queue import Queue
+import pytest
+from async_http import AsyncHttpPool, HttpError
+from fixture_server import FixtureServer
+
+@pytest.fixture
+def server():
+    server = FixtureServer(latency=0.05, missing_symbols=['MISSING'], idle_timeout=0.5).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def get_history_url(server, ticker_symbol):
+    return "{}/history/{}.csv?start=2020-01-01".format(server.get_url(), ticker_symbol)
+
+def test_keep_alive_reuses_one_connection(server):
+    async def run():
+        pool = AsyncHttpPool()
+        try:
+            bodies = [await pool.get(get_history_url(server, ticker_symbol)) for ticker_symbol in ['AAA', 'BBB', 'CCC', 'DDD']]
+        finally:
+            await pool.close()
+        return (pool, bodies)
+    (pool, bodies) = asyncio.run(run())
+    assert all(body.startswith(b'Date,Open,High,Low,Close,Volume,Adj Close\n') for body in bodies)
+    assert pool.requests_sent == 4
+    assert pool.connections_opened == 1
+
+def test_stale_connection_is_retried(server):
+    async def run():
+        pool = AsyncHttpPool()
+        try:
+            await pool.get(get_history_url(server, 'AAA'))
+            # Block the event loop, so the pool does not see the server close the idle connection
+            time.sleep(server.idle_timeout + 0.5)
+            body = await pool.get(get_history_url(server, 'BBB'))
+        finally:
+            await pool.close()
+        return (pool, body)
+    (pool, body) = asyncio.run(run())
+    assert body.startswith(b'Date,')
+    assert pool.connections_opened == 2
+    # The request on the stale connection, then its retry
+    assert pool.requests_sent == 3
+
+def test_not_found_raises_http_error(server):
+    async def run():
+        pool = AsyncHttpPool()
+        try:
+            await pool.get(get_history_url(server, 'MISSING'))
+        finally:
+            await pool.close()
+    with pytest.raises(HttpError) as error:
+        asyncio.run(run())
+    assert error.value.status == 404
+
+@pytest.fixture
+def loader(server, tmp_path, monkeypatch):
+    import stock_loader
+    monkeypatch.setenv('STOCKS_DATA_FOLDER', str(tmp_path))
+    stock_loader.initialize(quote_ttl=0, backend_name='local', backend_url=server.get_url())
+    return stock_loader
+
+def test_downloads_respect_concurrency_cap(loader, server):
+    (ready_queue, unknown_queue) = (Queue(), Queue())
+    ticker_symbols = ["T{}".format(i) for i in range(12)]
+    loader.download_historic_data(ticker_symbols, ready_queue.put, unknown_queue.put, concurrency=3)
+    assert sorted(loader.convert_to_list(ready_queue)) == sorted(ticker_symbols)
+    assert server.max_active_count == 3
+
+def test_unknown_symbol_reaches_unknown_queue(loader):
+    (ready_queue, unknown_queue) = (Queue(), Queue())
+    loader.download_historic_data(['AAA', 'MISSING'], ready_queue.put, unknown_queue.put, concurrency=2)
+    assert loader.convert_to_list(ready_queue) == ['AAA']
+    assert loader.convert_to_list(unknown_queue) == ['MISSING']
@@ -0,0 +1,38 @@
+'''Queries of daemon.py answered from the loaded universe'''
+import pytest
+from fixture_server import FixtureServer
+
+@pytest.fixture
+def server():
+    server = FixtureServer().start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def stock_daemon(tmp_path, monkeypatch, server):
+    import stock_loader
+    from daemon import StockDaemon
+    monkeypatch.setenv('STOCKS_DATA_FOLDER', str(tmp_path))
+    # Accounts are stored next to the scripts
+    monkeypatch.setattr(stock_loader.StockAssistant, 'get_account_store_file', lambda self: str(tmp_path / 'accounts.sqlite'))
+    stock_loader.initialize(quote_ttl=0, backend_name='local', backend_url=server.get_url())
+    return StockDaemon([])
+
+def commit_account(name, balance, holdings):
+    from accounts import AccountStore
+    from stock_loader import StockAssistant, StockAccount
+    default_account = StockAccount()
+    default_account.db_name = name
+    store = AccountStore(StockAssistant(default_account, None, None, False, False, run=False).get_account_store_file())
+    store.commit(name, balance, holdings)
+    store.close()
+
+def test_rebalance_keeps_the_case_of_the_holdings(stock_daemon, capsys):
+    # Like wealthfront.py, whose holdings are upper case
+    commit_account('wealthfront', 632.26, {'SCHB': (0.5, 1), 'LQD': (0.5, 2)})
+    stock_daemon.query_rebalance({'account': 'wealthfront', 'optimize': '1'})
+    output = capsys.readouterr().out
+    assert 'ERROR' not in output
+    assert '> Transactions:' in output
+    assert sorted(stock_daemon._universe.tickers) == ['LQD', 'SCHB']
@@ -0,0 +1,81 @@
+'''Refreshing stored histories with only the new bars (update_historic_data_delta)'''
+import asyncio
+import time
+import pytest
+from async_http import AsyncHttpPool
+from fixture_server import FixtureServer
+
+@pytest.fixture
+def server():
+    server = FixtureServer(missing_symbols=['GONE']).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def loader(tmp_path, monkeypatch):
+    import stock_loader
+    monkeypatch.setenv('STOCKS_DATA_FOLDER', str(tmp_path))
+    return stock_loader
+
+def download(loader, server, ticker_symbol):
+    loader.initialize(quote_ttl=0, backend_name='local', backend_url=server.get_url())
+    loader.download_historic_data([ticker_symbol], lambda ticker_symbol: None, lambda ticker_symbol: None)
+
+def make_stale(loader, ticker_symbol, scale=1.0):
+    '''Drop the 3 newest bars (the fixture CSV is newest first), scale the prices and mark it fetched 3 days ago'''
+    csv_file = loader.get_historical_data_csv_file(ticker_symbol)
+    with open(csv_file) as infile:
+        lines = infile.read().splitlines()
+    rows = []
+    for line in lines[4:]:
+        values = line.split(',')
+        rows.append(','.join([values[0]] + ["{:.6f}".format(float(value)*scale) for value in values[1:5]] +
+                             [values[5], "{:.6f}".format(float(values[6])*scale)]))
+    with open(csv_file, 'w') as outfile:
+        outfile.write('\n'.join([lines[0]] + rows) + '\n')
+    loader.get_manifest().update(ticker_symbol, fetched=time.time() - 3*86400, **loader.get_csv_fingerprint(csv_file))
+    loader.get_manifest().save()
+    return loader.get_manifest().get(ticker_symbol)
+
+def update_delta(loader, ticker_symbol, entry, backend_url):
+    loader.initialize(quote_ttl=0, backend_name='local', backend_url=backend_url)
+    async def run():
+        pool = AsyncHttpPool()
+        try:
+            return await loader.update_historic_data_delta(pool, ticker_symbol, entry)
+        finally:
+            await pool.close()
+    return asyncio.run(run())
+
+def test_delta_appends_new_bars(loader, server):
+    download(loader, server, 'AAA')
+    full_entry = loader.get_manifest().get('AAA')
+    entry = make_stale(loader, 'AAA')
+    assert update_delta(loader, 'AAA', entry, server.get_url())
+    assert loader.get_manifest().get('AAA')['last_date'] == full_entry['last_date']
+    assert loader.get_manifest().get('AAA')['rows'] == full_entry['rows']
+
+def test_restated_history_needs_full_download(loader, server):
+    download(loader, server, 'AAA')
+    entry = make_stale(loader, 'AAA', scale=2.0)
+    assert not update_delta(loader, 'AAA', entry, server.get_url())
+
+def test_rejected_range_counts_as_no_new_bars(loader, server):
+    download(loader, server, 'AAA')
+    entry = dict(make_stale(loader, 'AAA'), last_date=time.strftime("%Y-%m-%d", time.localtime(time.time() - 2*86400)))
+    # The fixture answers 404 for GONE, like a source rejecting a range without trading days
+    loader.get_manifest().update('GONE', **entry)
+    loader.get_manifest().save()
+    assert update_delta(loader, 'GONE', entry, server.get_url())
+    assert loader.get_manifest().get('GONE')['fetched'] > entry['fetched']
+
+def test_unreachable_source_keeps_stored_bars(loader, server):
+    download(loader, server, 'AAA')
+    entry = make_stale(loader, 'AAA')
+    # Nothing listens on the port of a closed server
+    closed_server = FixtureServer()
+    closed_url = closed_server.get_url()
+    closed_server.server_close()
+    assert update_delta(loader, 'AAA', entry, closed_url)
+    assert loader.get_manifest().get('AAA')['fetched'] == entry['fetched']
@@ -0,0 +1,20 @@
+'''Latest indicators of many tickers at once (stack_latest_bars)'''
+import numpy as np
+import pytest
+from indicators import stack_prices, stack_latest_bars, get_latest_indicators, INDICATOR_NAMES
+
+def make_columns(random, first_date, days):
+    return {'Date': np.arange(np.datetime64(first_date), np.datetime64(first_date) + days),
+            'Adj_Close': 100*np.exp(np.cumsum(random.normal(0, 0.01, days)))}
+
+def test_stacked_indicators_match_each_ticker_on_its_own():
+    random = np.random.default_rng(0)
+    # Another first date, fewer bars and an older last bar than the first ticker
+    columns_list = [make_columns(random, '2020-01-01', 1000), make_columns(random, '2020-01-01', 800),
+                    make_columns(random, '2020-06-01', 700), make_columns(random, '2021-01-01', 0)]
+    stacked = get_latest_indicators(stack_latest_bars(columns_list))
+    for i, columns in enumerate(columns_list):
+        (_, matrix) = stack_prices([columns])
+        alone = get_latest_indicators(matrix)
+        for name in INDICATOR_NAMES:
+            assert stacked[name][i] == pytest.approx(alone[name][0], nan_ok=True)
@@ -0,0 +1,123 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+import numpy as np
+
+# Upper bounds (in milliseconds) of the latency histogram buckets; the last bucket is open
+LATENCY_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+SLOWEST_TICKERS_COUNT = 5
+PROFILE_LINES = 30
+
+class StageTimings:
+    '''
+    Wall time spent per stage (download, parse_csv, quotes, stats, ...), recorded per
+    ticker where a stage handles one ticker at a time. Safe to use from many threads.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._start_time = time.perf_counter()
+        self._stages = dict()
+
+    def reset(self):
+        with self._lock:
+            self._start_time = time.perf_counter()
+            self._stages = dict()
+
+    def add(self, stage, seconds, ticker_symbol=None):
+        with self._lock:
+            self._stages.setdefault(stage, []).append((ticker_symbol, seconds))
+
+    @contextmanager
+    def timed(self, stage, ticker_symbol=None):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start_time, ticker_symbol)
+
+    def _get_stage_summary(self, samples):
+        seconds = np.array([s for _, s in samples])
+        counts = np.bincount(np.searchsorted(LATENCY_BUCKETS_MS, seconds*1000), minlength=len(LATENCY_BUCKETS_MS) + 1)
+        labels = ["<{}ms".format(bound) for bound in LATENCY_BUCKETS_MS] + [">={}ms".format(LATENCY_BUCKETS_MS[-1])]
+        slowest = sorted([sample for sample in samples if sample[0]], key=lambda x: x[1], reverse=True)[:SLOWEST_TICKERS_COUNT]
+        return {'count': len(seconds),
+                'total': float(seconds.sum()),
+                'mean': float(seconds.mean()),
+                'p50': float(np.percentile(seconds, 50)),
+                'p95': float(np.percentile(seconds, 95)),
+                'max': float(seconds.max()),
+                'histogram': {label: int(count) for label, count in zip(labels, counts) if count},
+                'slowest': [[ticker_symbol, seconds] for ticker_symbol, seconds in slowest]}
+
+    def get_summary(self):
+        '''@return: dict of stage -> count, total/mean/p50/p95/max seconds, latency histogram and slowest tickers'''
+        with self._lock:
+            stages = {stage: list(samples) for stage, samples in self._stages.items()}
+            elapsed = time.perf_counter() - self._start_time
+        return {'elapsed': elapsed,
+                'stages': {stage: self._get_stage_summary(samples) for stage, samples in stages.items()}}
+
+    def print_summary(self):
+        summary = self.get_summary()
+        print ("==================== TIMINGS ===========================")
+        print ("{:<16} {:>7} {:>9} {:>9} {:>9} {:>9}  {}".format('Stage', 'Count', 'Total(s)', 'p50(ms)', 'p95(ms)', 'Max(ms)', 'Slowest'))
+        for stage, stats in sorted(summary['stages'].items(), key=lambda x: x[1]['total'], reverse=True):
+            slowest = ', '.join("{} {:.0f}ms".format(ticker_symbol.upper(), 1000*seconds) for ticker_symbol, seconds in stats['slowest'][:3])
+            print ("{:<16} {:>7} {:>9.3f} {:>9.1f} {:>9.1f} {:>9.1f}  {}".format(stage, stats['count'], stats['total'],
+                                                                            1000*stats['p50'], 1000*stats['p95'], 1000*stats['max'], slowest))
+        print ("Elapsed: {:.3f}s (stage totals add up the time of concurrent workers)".format(summary['elapsed']))
+
+    def write_summary(self, output_file, **info):
+        '''Write get_summary() and info as JSON to output_file'''
+        summary = self.get_summary()
+        summary['timestamp'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        summary.update(info)
+        temp_file = output_file + '.tmp'
+        with open(temp_file, 'w') as outfile:
+            json.dump(summary, outfile, indent=2, sort_keys=True)
+        os.replace(temp_file, output_file)
+        print ("Wrote: {}".format(output_file))
+
+TIMINGS = StageTimings()
+
+def timed(stage, ticker_symbol=None):
+    '''with timed('parse_csv', ticker_symbol): ... adds the time of the block to TIMINGS'''
+    return TIMINGS.timed(stage, ticker_symbol)
+
+def run_profiled(function, output_file):
+    '''
+    Run function() under cProfile, including the threads it starts (pipeline stages,
+    executor callbacks), save the merged stats to output_file and print the top entries
+    '''
+    thread_profiles = []
+    def enable_thread_profile(frame, event, arg):
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12+ profiles every thread from the main profiler
+            return
+        thread_profiles.append(profile)
+    main_profile = cProfile.Profile()
+    threading.setprofile(enable_thread_profile)
+    main_profile.enable()
+    try:
+        return function()
+    finally:
+        main_profile.disable()
+        threading.setprofile(None)
+        stats = pstats.Stats(main_profile, stream=io.StringIO())
+        for profile in thread_profiles:
+            profile.create_stats()
+            stats.add(profile)
+        stats.dump_stats(output_file)
+        stats.stream = io.StringIO()
+        stats.sort_stats('cumulative').print_stats(PROFILE_LINES)
+        print (stats.stream.getvalue())
+        print ("Wrote: {} (open with python -m pstats)".format(output_file))
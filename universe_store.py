@@ -0,0 +1,235 @@
+import json
+import os
+import time
+from threading import Lock
+import numpy as np
+from file_lock import locked_file
+
+STORE_MAGIC = b'STKUNIV1'
+CHUNK_MAGIC = b'STKCHUNK'
+ALIGNMENT = 8
+# Compact when stale chunks take more than this fraction of the file
+COMPACT_STALE_RATIO = 0.5
+
+def get_padding(size):
+    return -size % ALIGNMENT
+
+class UniverseStore:
+    '''
+    Single container file with the bars of every ticker.
+
+    The file is a log of chunks: magic, header length, data length, JSON header (symbol,
+    source, rows and column offsets) and the 8-byte aligned columns. Updating a ticker
+    appends a new chunk in one write, so an update is atomic and readers of the older
+    chunk are not disturbed; the last chunk of a symbol wins. A chunk without rows only
+    records the source of a ticker whose bars must be parsed again.
+
+    The whole file is memory-mapped once and indexed by a scan of the chunk headers, so
+    the columns of many tickers are read without opening one file per ticker. compact()
+    rewrites the live chunks into a new file and swaps it in with os.replace.
+
+    Appends and compactions of all processes take the lock file next to the store, so
+    none of them is lost. The store is never truncated, since other processes may map
+    its pages: a chunk torn by a crashed writer is written over as a dead chunk instead.
+    '''
+    def __init__(self, store_file):
+        self._store_file = store_file
+        self._lock_file = store_file + '.lock'
+        self._lock = Lock()
+        self._index = dict()
+        self._buffer = None
+        self._scanned_size = 0
+        self._stale_bytes = 0
+        self._identity = None
+        self._load()
+
+    def get_file(self):
+        return self._store_file
+
+    def _load(self):
+        self._index = dict()
+        self._buffer = None
+        self._scanned_size = 0
+        self._stale_bytes = 0
+        self._identity = None
+        self._scan()
+
+    def _scan(self):
+        '''Index the chunks appended since the last scan; a torn chunk at the end is ignored'''
+        try:
+            stat = os.stat(self._store_file)
+        except OSError:
+            return
+        if self._identity and self._identity != (stat.st_dev, stat.st_ino):
+            # Compacted by another process: index the new file from the start
+            self._load()
+            return
+        size = stat.st_size
+        if size <= self._scanned_size:
+            return
+        self._identity = (stat.st_dev, stat.st_ino)
+        buffer = np.memmap(self._store_file, dtype=np.uint8, mode='r')
+        if bytes(buffer[:len(STORE_MAGIC)]) != STORE_MAGIC:
+            print ("INFO: Ignoring {}: not a universe store".format(self._store_file))
+            return
+        offset = max(self._scanned_size, len(STORE_MAGIC))
+        while offset + 16 <= size and bytes(buffer[offset:offset + 8]) == CHUNK_MAGIC:
+            (header_size, data_size) = buffer[offset + 8:offset + 16].view('<u4').tolist()
+            data_offset = offset + 16 + header_size
+            if data_offset + data_size > size:
+                break
+            try:
+                header = json.loads(bytes(buffer[offset + 16:data_offset]).decode('ascii'))
+            except ValueError:
+                break
+            header['chunk_offset'] = offset
+            header['data_offset'] = data_offset
+            header['chunk_size'] = data_offset + data_size - offset
+            offset = data_offset + data_size
+            if header.get('symbol') is None:
+                # Dead chunk over a torn one
+                self._stale_bytes += header['chunk_size']
+                continue
+            old_header = self._index.get(header['symbol'])
+            if old_header:
+                self._stale_bytes += old_header['chunk_size']
+            self._index[header['symbol']] = header
+        self._buffer = buffer
+        self._scanned_size = offset
+
+    def _get_header(self, ticker_symbol):
+        header = self._index.get(ticker_symbol)
+        if header is None:
+            # Another process may have appended it since the last scan
+            self._scan()
+            header = self._index.get(ticker_symbol)
+        return header
+
+    def get(self, ticker_symbol):
+        '''@return: (source, columns or None without stored bars), or None for an unknown ticker_symbol'''
+        with self._lock:
+            header = self._get_header(ticker_symbol)
+            if not header:
+                return None
+            return (header['source'], self._get_columns(header))
+
+    def _get_columns(self, header):
+        if header['rows'] is None:
+            return None
+        (rows, data_offset) = (header['rows'], header['data_offset'])
+        return {name: self._buffer[data_offset + offset:data_offset + offset + rows*8].view(dtype) for name, dtype, offset in header['columns']}
+
+    def get_info(self, ticker_symbol):
+        '''@return: dict of source, rows, last_date, checksum and updated (time of the chunk) of ticker_symbol, or None'''
+        with self._lock:
+            header = self._get_header(ticker_symbol)
+        return {key: header.get(key) for key in ['source', 'rows', 'last_date', 'checksum', 'updated']} if header else None
+
+    def get_source(self, ticker_symbol):
+        '''@return: name of the backend the bars of ticker_symbol came from, or None'''
+        with self._lock:
+            header = self._get_header(ticker_symbol)
+        return header['source'] if header else None
+
+    def get_columns(self, ticker_symbol):
+        '''@return: dict of column name -> read-only array view into the file, or None without stored bars'''
+        with self._lock:
+            header = self._get_header(ticker_symbol)
+            return self._get_columns(header) if header else None
+
+    def get_many(self, ticker_symbols):
+        '''@return: dict of ticker_symbol -> columns for the stored ticker_symbols, in one pass over the index'''
+        all_columns = dict()
+        with self._lock:
+            self._scan()
+            for ticker_symbol in ticker_symbols:
+                header = self._index.get(ticker_symbol)
+                columns = self._get_columns(header) if header else None
+                if columns is not None:
+                    all_columns[ticker_symbol] = columns
+        return all_columns
+
+    def _make_chunk(self, ticker_symbol, source, columns, column_types, checksum):
+        header = {'symbol': ticker_symbol, 'source': source, 'updated': time.time(), 'rows': None, 'last_date': None,
+                  'checksum': checksum, 'columns': []}
+        blocks = []
+        if columns is not None:
+            header['rows'] = len(columns['Date'])
+            header['last_date'] = str(columns['Date'][-1]) if len(columns['Date']) else None
+            offset = 0
+            for name, dtype in column_types:
+                block = np.ascontiguousarray(columns[name], dtype=dtype)
+                header['columns'].append([name, dtype, offset])
+                blocks.append(block.tobytes())
+                offset += block.nbytes
+        header_bytes = json.dumps(header).encode('ascii')
+        header_bytes += b' ' * get_padding(16 + len(header_bytes))
+        data = b''.join(blocks)
+        return b''.join([CHUNK_MAGIC, np.array([len(header_bytes), len(data)], dtype='<u4').tobytes(), header_bytes, data])
+
+    def _cover_torn_chunk(self, f, size):
+        '''Write a dead chunk over the bytes a crashed writer left after the last whole chunk'''
+        header_bytes = b'{"symbol": null}'
+        header_bytes += b' ' * get_padding(16 + len(header_bytes))
+        end = max(size + get_padding(size), self._scanned_size + 16 + len(header_bytes))
+        f.seek(size)
+        f.write(b'\0' * (end - size))
+        f.seek(self._scanned_size)
+        f.write(b''.join([CHUNK_MAGIC, np.array([len(header_bytes), end - self._scanned_size - 16 - len(header_bytes)], dtype='<u4').tobytes(),
+                          header_bytes]))
+
+    def _append(self, chunk):
+        with locked_file(self._lock_file):
+            # Index what other processes appended; nobody else is appending now
+            self._scan()
+            fd = os.open(self._store_file, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0))
+            with os.fdopen(fd, 'r+b') as f:
+                size = f.seek(0, os.SEEK_END)
+                if size == 0:
+                    f.write(STORE_MAGIC)
+                elif self._scanned_size and size > self._scanned_size:
+                    self._cover_torn_chunk(f, size)
+                    f.seek(0, os.SEEK_END)
+                f.write(chunk)
+
+    def put(self, ticker_symbol, source, columns, column_types, checksum=None):
+        '''
+        Append the bars of ticker_symbol
+        @param columns: dict of column name -> array, or None to only record the source
+                        (e.g. after a new download, until the bars are parsed again)
+        @param column_types: list of (column name, numpy dtype string) to store
+        @param checksum: checksum of the file the bars were parsed from
+        '''
+        chunk = self._make_chunk(ticker_symbol, source, columns, column_types, checksum)
+        with self._lock:
+            self._append(chunk)
+            self._scan()
+
+    def put_source(self, ticker_symbol, source):
+        self.put(ticker_symbol, source, None, [])
+
+    def get_stale_ratio(self):
+        return self._stale_bytes / self._scanned_size if self._scanned_size else 0
+
+    def compact(self):
+        '''Rewrite only the last chunk of every symbol into a new file and swap it in'''
+        with self._lock, locked_file(self._lock_file):
+            self._scan()
+            if not self._stale_bytes:
+                return
+            temp_file = "{}.{}.tmp".format(self._store_file, os.getpid())
+            try:
+                with open(temp_file, 'wb') as f:
+                    f.write(STORE_MAGIC)
+                    for header in self._index.values():
+                        f.write(bytes(self._buffer[header['chunk_offset']:header['chunk_offset'] + header['chunk_size']]))
+                os.replace(temp_file, self._store_file)
+            except OSError as e:
+                # e.g. another process still maps the store on Windows
+                print ("INFO: Could not compact {}: {}".format(self._store_file, e))
+                try:
+                    os.remove(temp_file)
+                except OSError:
+                    pass
+                return
+            self._load()
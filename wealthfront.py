@@ -19,7 +19,15 @@ def main():
                     args.add,
                     args.target_balance,
                     args.commit,
-                    args.refresh)
+                    args.refresh,
+                    args.quote_ttl,
+                    args.backend,
+                    args.backend_url,
+                    args.profile,
+                    args.optimize,
+                    args.as_of,
+                    args.risk,
+                    args.backtest)
     print ("Total elapsed time: {}".format(time.time()-start_time))
 
 if __name__ == '__main__':